@@ -0,0 +1,356 @@
+import functools
+import itertools
+import multiprocessing
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import metrics
+
+
+# Case-insensitive substring search over the distinct names of one key column. Every name that contains "abc"
+# also contains "ab", so a query only rescans the names matched by the longest recent prefix of it: while the
+# user types, each keystroke scans the previous matches instead of the whole catalogue.
+class NameIndex:
+    def __init__(self, names, recent=256):
+        self.names = [str(name).casefold() for name in names]
+        self.size = recent
+        self.recent = OrderedDict()
+        self.lock = threading.Lock()
+
+    # Boolean mask over the distinct names
+    def matches(self, query):
+        query = query.casefold()
+        with self.lock:
+            found = self.recent.get(query)
+            if found is not None:
+                self.recent.move_to_end(query)
+            else:
+                candidates = next((self.recent[query[:end]] for end in range(len(query) - 1, 0, -1)
+                                   if query[:end] in self.recent), range(len(self.names)))
+        if found is None:
+            found = [i for i in candidates if query in self.names[i]]
+            with self.lock:
+                self.recent[query] = found
+                if len(self.recent) > self.size:
+                    self.recent.popitem(last=False)
+        mask = np.zeros(len(self.names), dtype=bool)
+        mask[found] = True
+        return mask
+
+
+# Positions of the k largest values, largest first and ties in position order (all positions when k is None).
+# A partial selection finds the k-th largest value first, so only the values at least as large get sorted.
+def ranked(values, k=None):
+    if k is not None and k < len(values):
+        if k <= 0:
+            return np.arange(0)
+        kth = np.partition(values, len(values) - k)[len(values) - k]
+        candidates = np.flatnonzero(values >= kth)
+    else:
+        candidates = np.arange(len(values))
+    return candidates[np.argsort(-values[candidates], kind="stable")][:k]
+
+
+# Smallest integer type for the codes into categories, as pandas picks for categoricals
+def code_type(categories):
+    return np.int8 if len(categories) < 2 ** 7 else np.int16 if len(categories) < 2 ** 15 else np.int32
+
+
+# The queries of the callbacks over monthly rollups of the chart table, one row per key (e.g. country and artist),
+# given present(): the keys below some values of the leading key columns that have chart rows in a slider range.
+# values holds the names of the codes of every key column.
+class Rollup:
+    # Names of the codes of the key column at level
+    def labels(self, level, codes):
+        return self.values[level][codes]
+
+    def any(self, start, end, *values):
+        return len(self.present(start, end, values)[1]) > 0
+
+    # Sorted values of the key column below *values that have chart rows in [start, end]
+    def members(self, start, end, *values):
+        codes, _ = self.present(start, end, values)
+        return self.labels(len(values), codes[len(values)])
+
+    # At most n members below *values with chart rows in [start, end] whose name contains query, by descending
+    # streams in the range (ties in name order). Selected members (one or a list) with rows in range are always
+    # kept, first.
+    def search(self, start, end, values, query, n, selected=None):
+        level = len(values)
+        codes, streams = self.present(start, end, values)
+        codes = codes[level]
+        names = self.labels(level, codes)
+        if query:
+            index = self.indexes.get(level)
+            if index is None:
+                index = self.indexes[level] = NameIndex(self.values[level])
+            keep = index.matches(query)[codes]
+            found = list(names[keep][ranked(streams[keep], n)])
+        else:
+            found = list(names[ranked(streams, n)])
+        selected = selected if isinstance(selected, list) else [] if selected is None else [selected]
+        return [member for member in selected if member not in found and member in names] + found
+
+    # The k members below *values with the most streams in [start, end] (all of them when k is None) and their
+    # streams, most streamed first and ties in name order
+    def top(self, start, end, values, k=None):
+        codes, streams = self.present(start, end, values)
+        order = ranked(streams, k)
+        return self.labels(len(values), codes[len(values)][order]), streams[order]
+
+    # Position of member in the ranking of top(), or None when it has no chart rows in [start, end]
+    def rank(self, start, end, values, member):
+        codes, streams = self.present(start, end, values)
+        at = np.flatnonzero(codes[len(values)] == self.code(len(values), member))
+        if not len(at):
+            return None
+        at = at[0]
+        return int((streams > streams[at]).sum() + (streams[:at] == streams[at]).sum())
+
+    # The k members below *values with the most streams in [start, end], summed over the values of the key
+    # column by (a list in values), and their streams for each of those values: a members x values table, most
+    # streamed first and ties in name order
+    def pivot(self, start, end, values, by, k=None):
+        codes, streams = self.present(start, end, values)
+        members, inverse = np.unique(codes[len(values)], return_inverse=True)
+        columns = pd.Index(values[by]).get_indexer(self.labels(by, codes[by]))
+        table = np.zeros((len(members), len(values[by])), dtype=np.int64)
+        np.add.at(table, (inverse, columns), streams)
+        order = ranked(table.sum(axis=1), k)
+        return pd.DataFrame(table[order], index=self.labels(len(values), members[order]), columns=values[by])
+
+
+# Monthly rollups of the chart table in memory: the rows are sorted by the codes of the key columns, with the
+# streams of every month the key has chart rows in. Only those (row, month) cells are stored, as row * n_months +
+# month in ascending order together with the running sum of their streams, so the streams of a row over any slider
+# range [i, j] are the difference of two running sums found by binary search instead of a scan over every row of
+# df. A row without cells in the range has no chart rows there, which tells it apart from
+# a row with zero streams.
+class Cube(Rollup):
+    def __init__(self, names, codes, categories, n_months, cells, cumulative, orders=None):
+        self.names = list(names)
+        # Codes of the key columns into their categories, which are sorted like the codes
+        self.codes = list(codes)
+        self.categories = [pd.Index(values) for values in categories]
+        self.values = [values.to_numpy(dtype=object) for values in self.categories]
+        self.dtypes = [pd.CategoricalDtype(values) for values in self.categories]
+        self.n_months = n_months
+        self.cells = cells
+        self.cumulative = cumulative
+        # Other orders of the rows, by other key columns first ({columns: permutation of the rows}), with the
+        # sorted codes of those columns: e.g. the rows of one artist in every country, for the map
+        self.orders = {}
+        for columns, permutation in (orders or {}).items():
+            levels = [self.names.index(column) for column in columns]
+            self.orders[tuple(columns)] = (permutation, levels, [self.codes[level][permutation] for level in levels])
+        # Name indexes of the key columns, built on the first search
+        self.indexes = {}
+
+    def __len__(self):
+        return len(self.codes[0])
+
+    def code(self, level, value):
+        try:
+            return self.categories[level].get_loc(value)
+        except (KeyError, TypeError):
+            return None
+
+    # Range of the rows sorted by the key columns at levels, whose sorted codes are codes, that have values there
+    def span(self, levels, codes, values):
+        lo, hi = 0, len(self)
+        for level, sorted_codes, value in zip(levels, codes, values):
+            code = self.code(level, value)
+            if code is None:
+                return 0, 0
+            sorted_codes = sorted_codes[lo:hi]
+            lo, hi = lo + sorted_codes.searchsorted(code), lo + sorted_codes.searchsorted(code, "right")
+        return int(lo), int(hi)
+
+    # Rows of the block of *values, values of the leading key columns. The rows are sorted by key, so every value
+    # of them owns one contiguous block of rows. Together with the cells this is an inverted index, e.g.
+    # country -> artist -> month -> tracks.
+    def block(self, *values):
+        return slice(*self.span(range(len(values)), self.codes, values))
+
+    # Rows of the blocks of every combination of values, where a value can also be a list (comparisons), in key
+    # order
+    def select(self, *values):
+        if not any(isinstance(value, list) for value in values):
+            return self.block(*values)
+        choices = [value if isinstance(value, list) else [value] for value in values]
+        blocks = [self.block(*combination) for combination in itertools.product(*choices)]
+        return np.unique(np.concatenate([np.arange(block.start, block.stop) for block in blocks] + [np.arange(0)]))
+
+    # Rows whose key columns have the values of where, {column: value or list of values}, in key order. The
+    # columns are searched in the leading key columns or those of one of the other orders, and scanned otherwise.
+    def where(self, where):
+        columns = tuple(where)
+        if list(columns) == self.names[:len(columns)]:
+            return self.select(*where.values())
+        order = next((order for key, order in self.orders.items() if key[:len(columns)] == columns), None)
+        if order is None:
+            keep = np.ones(len(self), dtype=bool)
+            for column, value in where.items():
+                level = self.names.index(column)
+                codes = [self.code(level, v) for v in (value if isinstance(value, list) else [value])]
+                keep &= np.isin(self.codes[level], [code for code in codes if code is not None])
+            return np.flatnonzero(keep)
+        permutation, levels, codes = order
+        choices = [value if isinstance(value, list) else [value] for value in where.values()]
+        spans = [self.span(levels, codes, combination) for combination in itertools.product(*choices)]
+        return np.unique(np.concatenate([permutation[lo:hi] for lo, hi in spans] + [np.arange(0)]))
+
+    def positions(self, rows):
+        return np.arange(*rows.indices(len(self))) if isinstance(rows, slice) else rows
+
+    # Which of rows have chart rows in [start, end], and the streams of each
+    def sums(self, start, end, rows=slice(None)):
+        base = self.positions(rows).astype(self.cells.dtype) * self.n_months
+        lo = self.cells.searchsorted(base + start)
+        hi = self.cells.searchsorted(base + end + 1)
+        present = hi > lo
+        metrics.rows(len(present), int(present.sum()))
+        return present, self.cumulative[hi] - self.cumulative[lo]
+
+    # Codes of the key columns of the keys below *values with chart rows in [start, end], in key order, and their
+    # streams
+    def present(self, start, end, values):
+        rows = self.select(*values)
+        present, streams = self.sums(start, end, rows)
+        rows = self.positions(rows)[present]
+        return [codes[rows] for codes in self.codes], streams[present]
+
+    # Slider codes of the months with chart rows in the block of *values
+    def months(self, *values):
+        rows = self.block(*values)
+        cells = self.cells[self.cells.searchsorted(rows.start * self.n_months):
+                           self.cells.searchsorted(rows.stop * self.n_months)]
+        return np.unique(cells % self.n_months)
+
+    # Keys with at least one chart row in [start, end], together with their summed streams: all of them, or those
+    # with the values of where (see where())
+    def totals(self, start, end, where=None):
+        rows = self.where(where) if where else slice(None)
+        present, streams = self.sums(start, end, rows)
+        rows = self.positions(rows)[present]
+        out = pd.DataFrame({name: pd.Categorical.from_codes(codes[rows], dtype=dtype)
+                            for name, codes, dtype in zip(self.names, self.codes, self.dtypes)})
+        out["Streams"] = streams[present]
+        return out
+
+    # The key codes, the month and the streams of every cell
+    def unpack(self):
+        rows, months = np.divmod(self.cells, self.n_months)
+        return [codes[rows] for codes in self.codes], months, np.diff(self.cumulative)
+
+    # Cube over the union of both key sets, with n_months month columns. month_codes and other_month_codes
+    # give the new slider code of each month column of this cube and of the other one.
+    def merge(self, other, n_months, month_codes, other_month_codes):
+        return combine([self, other], n_months, [month_codes, other_month_codes])
+
+
+# Cube of the key columns names from chart rows or partial sums: the codes of those columns into categories, and
+# the slider month and the streams of each. Rows of the same key and month are summed. orders lists the key
+# columns of the other orders of the rows (see Cube).
+def code_cube(names, codes, categories, month_codes, streams, n_months, orders=()):
+    sizes = [len(values) for values in categories]
+    key = np.ravel_multi_index(codes, sizes) * n_months + month_codes
+    order = np.argsort(key, kind="stable")
+    key = key[order]
+    starts = np.flatnonzero(np.diff(key, prepend=-1))
+    sums = np.add.reduceat(streams[order], starts) if len(starts) else streams[:0]
+    keys, months = np.divmod(key[starts], n_months)
+    first = np.diff(keys, prepend=-1) != 0
+    rows = np.cumsum(first) - 1
+    cell_type = np.int32 if first.sum() * n_months < 2 ** 31 else np.int64
+    key_codes = [c.astype(code_type(values)) for c, values in zip(np.unravel_index(keys[first], sizes), categories)]
+    permutations = {}
+    for columns in orders:
+        levels = [names.index(column) for column in columns]
+        levels += [level for level in range(len(names)) if level not in levels]
+        permutations[tuple(columns)] = np.lexsort([key_codes[level] for level in reversed(levels)]).astype(np.int32)
+    return Cube(names, key_codes, categories, n_months, (rows * n_months + months).astype(cell_type),
+                np.concatenate([[0], np.cumsum(sums)]).astype(np.int64), permutations)
+
+
+# Cube over the union of the keys of cubes, with the sum of their cells and n_months month columns. month_codes
+# gives the new slider code of each month of every cube. The cost depends on the number of cells only, not on the
+# number of chart rows behind them.
+def combine(cubes, n_months, month_codes):
+    names = cubes[0].names
+    categories = [functools.reduce(lambda a, b: a.union(b), [cube.categories[level] for cube in cubes])
+                  for level in range(len(names))]
+    codes, months, streams = [[] for _ in names], [], []
+    for cube, codes_date in zip(cubes, month_codes):
+        cell_codes, cell_months, cell_streams = cube.unpack()
+        for level, values in enumerate(categories):
+            codes[level].append(values.get_indexer(cube.categories[level])[cell_codes[level]])
+        months.append(np.asarray(codes_date)[cell_months])
+        streams.append(cell_streams)
+    return code_cube(names, [np.concatenate(c) for c in codes], categories, np.concatenate(months),
+                     np.concatenate(streams), n_months, list(cubes[0].orders))
+
+
+def build_cube(df, columns, n_months, orders=()):
+    return code_cube(columns, [df[column].cat.codes.to_numpy() for column in columns],
+                     [df[column].cat.categories for column in columns], df["month_code"].to_numpy(),
+                     df["Streams"].to_numpy(), n_months, orders)
+
+
+# Cubes by country, by country and artist and by country, artist and track, with their other orders. The
+# artist-first orders serve the choropleth when artists (and songs) are selected, since it needs every country of
+# them.
+CUBES = {
+    "country": (["Country"], []),
+    "country_artist": (["Country", "Artist"], [["Artist"]]),
+    "country_track": (["Country", "Artist", "Track Name"], [["Artist", "Track Name"]]),
+}
+
+# The table the forked build workers read
+shared = None
+
+
+# Countries (codes) of each of n build workers: the countries with the most chart rows first, each to the worker
+# with the fewest rows so far
+def partition(country_codes, n):
+    sizes = np.bincount(country_codes)
+    groups, loads = [[] for _ in range(n)], [0] * n
+    for code in np.argsort(-sizes, kind="stable"):
+        if sizes[code]:
+            worker = loads.index(min(loads))
+            groups[worker].append(code)
+            loads[worker] += sizes[code]
+    return [group for group in groups if group]
+
+
+# The cells of every cube over the chart rows of countries, partial sums of the full cubes
+def build_part(countries, n_months):
+    part = shared[np.isin(shared["Country"].cat.codes.to_numpy(), countries)]
+    return {name: build_cube(part, columns, n_months).unpack() for name, (columns, _) in CUBES.items()}
+
+
+# Every cube is one pass over every chart row. With workers > 1 the chart rows are split by country between forked
+# processes, which read df from the parent's memory (copy-on-write) instead of receiving a copy and send back only
+# the cells of their countries; the cells of all of them are then merged into the cubes.
+def build_cubes(df, n_months, workers=1):
+    global shared
+    if workers > 1 and "fork" in multiprocessing.get_all_start_methods():
+        groups = partition(df["Country"].cat.codes.to_numpy(), workers)
+        shared = df
+        try:
+            with ProcessPoolExecutor(len(groups), mp_context=multiprocessing.get_context("fork")) as pool:
+                parts = list(pool.map(build_part, groups, [n_months] * len(groups)))
+        finally:
+            shared = None
+        cubes = {}
+        for name, (columns, orders) in CUBES.items():
+            codes, months, streams = zip(*[part[name] for part in parts])
+            cubes[name] = code_cube(columns, [np.concatenate(level) for level in zip(*codes)],
+                                    [df[column].cat.categories for column in columns], np.concatenate(months),
+                                    np.concatenate(streams), n_months, orders)
+        return cubes
+    return {name: build_cube(df, columns, n_months, orders) for name, (columns, orders) in CUBES.items()}
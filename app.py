@@ -1,10 +1,25 @@
+# Start of the imports phase of the startup report (metrics.startup_report)
+import time
+started = time.perf_counter()
 import dash
 import dash_core_components as dcc
 import dash_html_components as html
-from dash.dependencies import Input, Output
-import pandas as pd
-import plotly.graph_objs as go
+from dash.dependencies import ClientsideFunction, Input, Output, State
 import ast
+import clientside
+import itertools
+import compression
+import figures
+import os
+import metrics
+import timeseries
+from cache import make_cache, memoize
+from data import ChartData, load, source_version
+from engine import FILTERS, PandasEngine, SQLiteEngine
+from prerender import code_version, load_bundle
+from refresh import ChartStore
+
+metrics.startup_phase("imports", started)
 
 external_scripts = [
     {
@@ -20,276 +35,352 @@ server = app.server
 # When going on github we should put this line of code #
 # server = app.server()
 
-# read data
-df = pd.read_csv("data/spotify_month.csv")
-df = df.dropna()
-# Only keep cases where we have data for multiple months
-df["to_delete"] = df["Track URL"] + df["Country"]
-df = df[df["to_delete"].duplicated(keep=False)]
-
-# Add map codes
-df_countries = pd.read_csv("https://raw.githubusercontent.com/plotly/datasets/master/gapminder_with_codes.csv")
-df_countries = df_countries.loc[:, ["country", "iso_alpha"]]
-df_countries = df_countries.groupby(["country"]).first()
-df = df.merge(df_countries, left_on="Country", right_index=True, how="left")
-
-artist = sorted(df["Artist"].unique())
-song = sorted(df["Track Name"].unique())
-av_country = sorted(df["Country"].unique())
-months_years = sorted(df["month_year"].unique())
-# Dictionaries to use for the year range slider
-date_codes = {}
-codes_marks = {}
-month_dict = {1: "Jan", 2: "Feb", 3: "Mar", 4: "Apr", 5: "May", 6: "Jun", 7: "Jul", 8: "Aug", 9: "Sep", 10: "Oct",
-              11: "Nov", 12: "Dec"}
-
-for i in range(len(months_years)):
-    if months_years[i][5] == "0":  # January to September
-        text = month_dict[int(months_years[i][6])]
-    else:  # October to December
-        text = month_dict[int(months_years[i][-2:])]
-    text += ("-" + months_years[i][:4])
-    date_codes[i] = months_years[i]
-    codes_marks[i] = text
-
-codes_date = {v: k for k, v in date_codes.items()}
+chart_csv = os.environ.get("CHART_CSV", "data/spotify_month.csv")
+
+
+# read data, from the memory-mapped snapshot built by ingest.py when there is one, rollups included. Otherwise
+# workers processes (CHART_BUILD_WORKERS by default) build the rollups of the callbacks in parallel.
+# The chart rows and their rollups stay in the SQLite database of CHART_DATABASE (written by ingest.py --database)
+# when it is set, and are loaded into memory otherwise.
+# The version of the data, which the cached outputs are keyed on, names the files it was read from and the code, so
+# the entries of a shared cache directory are not served after a restart on other data or code.
+def load_chart(workers=None):
+    if workers is None:
+        workers = int(os.environ.get("CHART_BUILD_WORKERS", 1))
+    with metrics.phase("data"):
+        if os.environ.get("CHART_DATABASE"):
+            engine = SQLiteEngine(os.environ["CHART_DATABASE"])
+            df, months_years, cubes, history = None, engine.months_years, None, None
+            sources = [os.environ["CHART_DATABASE"]]
+        else:
+            snapshot_dir = os.environ.get("CHART_SNAPSHOT_DIR", "data/snapshot")
+            df, months_years, cubes, history = load(chart_csv, snapshot_dir)
+            engine = PandasEngine(df)
+            sources = [chart_csv, os.path.join(snapshot_dir, "meta.json")]
+    with metrics.phase("rollups"):
+        if cubes is None:
+            cubes = engine.cubes(len(months_years), workers)
+        return ChartData(df, months_years, cubes, version=source_version(sources, code_version()), engine=engine,
+                         history=history)
+
+
+# With CHART_LAZY, the data is loaded in the background (with the other threads) and the server accepts requests
+# at once; callbacks and page loads wait for the data until it is there
+lazy = os.environ.get("CHART_LAZY", "0") != "0"
+store = ChartStore(None if lazy else load_chart())
+
+# Per-callback latency, rows and payload metrics on /metrics
+metrics.register(server)
+
+# gzip (or brotli) compression of the callback responses, at CHART_COMPRESS_LEVEL; 0 turns it off
+if int(os.environ.get("CHART_COMPRESS_LEVEL", 6)):
+    compression.register(server, int(os.environ.get("CHART_COMPRESS_LEVEL", 6)))
+
+# Most points of the line chart: it shows days, weeks or months, whichever fit for the slider span
+line_points = int(os.environ.get("CHART_LINE_POINTS", 400))
+
+# The artist and song dropdowns are searched on the server and only get this many options, the most streamed first
+options_limit = int(os.environ.get("CHART_OPTIONS_LIMIT", 50))
+
+# The landing view of every country, pre-rendered by prerender.py, is answered from its files while they match
+# the data, these settings and the code
+prerendered_dir = os.environ.get("CHART_PRERENDERED_DIR", "data/prerendered")
+with metrics.phase("prerendered"):
+    bundle = load_bundle(chart_csv, prerendered_dir, options_limit, line_points) if prerendered_dir else None
+if bundle is not None:
+    bundle.register(server, store)
+
+
+# New monthly chart files dropped in CHART_APPEND_DIR are appended without a restart; CHART_PROFILE_SLOW_MS
+# samples the stacks of callbacks slower than that into the log. Threads do not survive a fork, so when
+# gunicorn preloads the app (gunicorn.conf.py sets CHART_PRELOAD) every worker starts them after the fork.
+def start_threads():
+    if lazy:
+        # The lazy load runs in a thread, and forking build processes while the server's other threads hold locks
+        # (logging, imports, the allocator) can deadlock the children, so it builds the rollups in-process
+        store.load(lambda: load_chart(workers=1))
+    if os.environ.get("CHART_APPEND_DIR"):
+        store.watch(os.environ["CHART_APPEND_DIR"], int(os.environ.get("CHART_APPEND_INTERVAL", 60)))
+    if os.environ.get("CHART_PROFILE_SLOW_MS"):
+        metrics.profiler.start(float(os.environ["CHART_PROFILE_SLOW_MS"]) / 1000)
+
+
+if not os.environ.get("CHART_PRELOAD"):
+    start_threads()
+
+# Serialized outputs of the chart and option callbacks, keyed on their normalized filters
+chart_cache = make_cache()
+metrics.caches["chart"] = chart_cache
+
+
+def data_version():
+    return store.current.version
+
+
+# The values of a filter: the artist, song and compare dropdowns are multi-select and give lists, empty when cleared
+def selection(value):
+    if value is None:
+        return []
+    return list(value) if isinstance(value, (list, tuple)) else [value]
+
+
+# The selected country first, then the other compared countries
+def chart_countries(country, compare):
+    country = country or "Global"
+    return [country] + [c for c in dict.fromkeys(selection(compare)) if c != country]
+
+
+def chart_filters(country, compare, artist, song, date):
+    countries = chart_countries(country, compare)
+    return countries[0], countries[1:], selection(artist), selection(song), date or store.current.full_range
+
+
+def map_filters(artist, song, date):
+    return selection(artist), selection(song), date or store.current.full_range
+
+
+# "A", "A and B", "A, B and C"
+def listing(names):
+    names = [str(name) for name in names]
+    return names[0] if len(names) == 1 else ", ".join(names[:-1]) + " and " + names[-1]
+
 
 # Building the app
 app.title = "Spotify - Music Trends"
 
-app.layout = html.Div([
-    html.Div([
-        html.Div(
-            [
-                html.A([
-                    html.Img(
-                        src=app.get_asset_url("spotify-logo.png"),
-                        alt="Spotify's logo",
-                        id="logo",
+
+# Built on every page load, so the page shows the latest appended months
+def serve_layout():
+    return layout(store.current)
+
+
+# The page for chart. Without a chart, only its components, which Dash checks the callbacks against.
+def layout(chart):
+    if chart is not None:
+        countries, marks, lookup = chart.av_country, chart.codes_marks, clientside.lookup(chart)
+    else:
+        countries, marks, lookup = [], {0: ""}, None
+    return html.Div([
+        # Month labels and data availability for the clientside callbacks
+        dcc.Store(id="chart_lookup", data=lookup),
+        html.Div([
+            html.Div(
+                [
+                    html.A([
+                        html.Img(
+                            src=app.get_asset_url("spotify-logo.png"),
+                            alt="Spotify's logo",
+                            id="logo",
+                        ),
+                    ],
+                        href="https://www.spotify.com",
+                        target="_blank",
+                    ),
+                    html.P(
+                        "Music Trends",
+                        id="app_title"
                     ),
                 ],
-                    href="https://www.spotify.com",
-                    target="_blank",
-                ),
-                html.P(
-                    "Music Trends",
-                    id="app_title"
-                ),
-            ],
-            className="top_left"
-        ),
-        html.Div([
+                className="top_left"
+            ),
             html.Div([
-                html.P(
-                    "Filter by country", className="filter_by"
-                ),
                 html.Div([
-                    dcc.Dropdown(
-                        id="country",
-                        options=[{"label": i, "value": i} for i in av_country],
-                        value="Global")
-                ],
-                    className="filtering_dropdown"
-                ),
-                html.P(
-                    "Filter by month/year", className="filter_by"
-                ),
-                html.Div([
-                    dcc.RangeSlider(
-                        id="date_slider",
-                        min=min(date_codes.keys()),
-                        max=max(date_codes.keys()),
-                        step=None,
-                        marks={i: ({"label": codes_marks[i], "style":{"display": "none"}} if i not in [0, 12, 24]
-                                   else {"label": codes_marks[i]}) for i in codes_marks},
-                        value=[min(date_codes.keys()), max(date_codes.keys())],
-                        allowCross=False,
-                        pushable=1,
+                    html.P(
+                        "Filter by country", className="filter_by"
                     ),
-                    html.Div(id="output_slider")
-                ],
-                ),
-                html.P(
-                    "Filter by artist", className="filter_by"
-                ),
-                html.Div([
-                    dcc.Dropdown(
-                        id="artist",
-                        options=[{"label": i, "value": i} for i in artist])
-                ],
-                    className="filtering_dropdown"
-                ),
-                html.P(
-                    "Filter by song", className="filter_by"
-                ),
+                    html.Div([
+                        dcc.Dropdown(
+                            id="country",
+                            options=[{"label": i, "value": i} for i in countries],
+                            value="Global")
+                    ],
+                        className="filtering_dropdown"
+                    ),
+                    html.P(
+                        "Compare with countries", className="filter_by"
+                    ),
+                    html.Div([
+                        dcc.Dropdown(
+                            id="compare",
+                            options=[{"label": i, "value": i} for i in countries],
+                            multi=True)
+                    ],
+                        className="filtering_dropdown"
+                    ),
+                    html.P(
+                        "Filter by month/year", className="filter_by"
+                    ),
+                    html.Div([
+                        dcc.RangeSlider(
+                            id="date_slider",
+                            min=min(marks),
+                            max=max(marks),
+                            step=None,
+                            marks={i: ({"label": marks[i], "style":{"display": "none"}}
+                                       if i not in [0, 12, 24] else {"label": marks[i]})
+                                   for i in marks},
+                            value=[min(marks), max(marks)],
+                            allowCross=False,
+                            pushable=1,
+                        ),
+                        html.Div(id="output_slider")
+                    ],
+                    ),
+                    html.P(
+                        "Filter by artist", className="filter_by"
+                    ),
+                    html.Div([
+                        dcc.Dropdown(
+                            id="artist",
+                            options=[],
+                            multi=True)
+                    ],
+                        className="filtering_dropdown"
+                    ),
+                    html.P(
+                        "Filter by song", className="filter_by"
+                    ),
+                    html.Div([
+                        dcc.Dropdown(
+                            id="song",
+                            options=[],
+                            multi=True
+                        )
+                    ],
+                        className="filtering_dropdown"
+                    ),
+
+                ]),
+            ],
+                className="grid_item bottom_left"
+            ),
+
+            html.Div([
                 html.Div([
-                    dcc.Dropdown(
-                        id="song",
-                        options=[{"label": i, "value": i} for i in song]
+                    dcc.Loading([
+                        dcc.Graph(id="choropleth_map", figure=figures.EMPTY_CHOROPLETH)],
+                        type='circle', color='#1ED760', id="map-loading"
                     )
                 ],
-                    className="filtering_dropdown"
+                    className="graph"
                 ),
+            ],
+                className="grid_item right"
+            ),
 
-            ]),
         ],
-            className="grid_item bottom_left"
+            className="first_grid"
         ),
 
         html.Div([
             html.Div([
                 dcc.Loading([
-                    dcc.Graph(id="choropleth_map")],
-                    type='circle', color='#1ED760', id="map-loading"
+                    dcc.Graph(id="bar_chart", figure=figures.EMPTY_BAR),
+                ], type='circle', color='#1ED760', id="bar-loading"),
+                html.P(
+                    "Songs", id="ylabel"
                 )
             ],
-                className="graph"
+                className="grid_item"
+            ),
+            html.Div([
+                html.Div([
+                    dcc.Loading([
+                        dcc.Graph(id="line_chart", figure=figures.EMPTY_LINE)], type='circle', color='#1ED760', id="line-loading"
+                    )
+                ],
+                    className="graph"
+                ),
+            ],
+                className="grid_item"
             ),
         ],
-            className="grid_item right"
+            className="second_grid"
         ),
 
-    ],
-        className="first_grid"
-    ),
-
-    html.Div([
-        html.Div([
-            dcc.Loading([
-                dcc.Graph(id="bar_chart"),
-            ], type='circle', color='#1ED760', id="bar-loading"),
-            html.P(
-                "Songs", id="ylabel"
-            )
-        ],
-            className="grid_item"
-        ),
         html.Div([
+
             html.Div([
-                dcc.Loading([
-                    dcc.Graph(id="line_chart")], type='circle', color='#1ED760', id="line-loading"
-                )
+                html.P(
+                    "x", id="close_text"
+                ),
             ],
-                className="graph"
+                id="popup_close_button"
+            ),
+            html.P(
+                "No data available for this selection!", id="popup_text"
             ),
+
         ],
-            className="grid_item"
+            id="popup_error"
         ),
-    ],
-        className="second_grid"
-    ),
 
-    html.Div([
+        html.Footer([
+            html.Label(["Data Visualization | Fall Semester 2019 | Abdallah Zaher, M20190684 | "
+                        "Cristina Mousinho, M20190303 | Gabriel Santos, M20190925 | Tobias Kutscher, M20190188 | "
+                        "Data from: ", html.A("Spotify | Charts",
+                                              href="https://spotifycharts.com/regional", target="_blank")])
 
-        html.Div([
-            html.P(
-                "x", id="close_text"
-            ),
         ],
-            id="popup_close_button"
-        ),
-        html.P(
-            "No data available for this selection!", id="popup_text"
+            className="footer"
         ),
+    ])
 
-    ],
-        id="popup_error"
-    ),
 
-    html.Footer([
-        html.Label(["Data Visualization | Fall Semester 2019 | Abdallah Zaher, M20190684 | "
-                    "Cristina Mousinho, M20190303 | Gabriel Santos, M20190925 | Tobias Kutscher, M20190188 | "
-                    "Data from: ", html.A("Spotify | Charts",
-                                          href="https://spotifycharts.com/regional", target="_blank")])
-
-    ],
-        className="footer"
-    ),
-])
+# Checking the callbacks against the full layout would build it (and wait for the data) at import, and send it
+# with every page
+with metrics.phase("layout"):
+    app.validation_layout = layout(None)
+app.layout = serve_layout
 
 
 # Setting filters' values, options, marks, (...)
 
 
-@app.callback(
-    Output("artist", "value"),
-    [Input("country", "value")])
-def clean_values(selected_artist):
-    del selected_artist  # Avoids error: "Parameter 'selected_artist' value is not used"
-    return None
-
+# Pure presentation callbacks run in the browser (assets/clientside.js), from the chart_lookup table
+app.clientside_callback(
+    ClientsideFunction(namespace="spotify", function_name="countryFilters"),
+    [Output("artist", "value"),
+     Output("date_slider", "marks"),
+     Output("date_slider", "className"),
+     Output("date_slider", "value")],
+    [Input("country", "value"),
+     Input("chart_lookup", "data")])
 
-@app.callback(
+app.clientside_callback(
+    ClientsideFunction(namespace="spotify", function_name="sliderLabel"),
     Output("output_slider", "children"),
-    [Input("date_slider", "value")])
-def update_output(value):
-    if value:
-        return "From " + codes_marks[value[0]] + " to " + codes_marks[value[1]]
+    [Input("date_slider", "value"),
+     Input("chart_lookup", "data")])
 
-
-@app.callback(
-    Output("date_slider", "marks"),
-    [Input("country", "value")])
-def set_date_options(selected_country):
-    if selected_country:
-        return {codes_date[j]: ({"label": codes_marks[codes_date[j]], "style": {"display": "none"}}
-                                if codes_date[j] not in [0, 12, 24] else {"label": codes_marks[codes_date[j]]})
-                for j in sorted(df[df["Country"] == selected_country]["month_year"].unique())}
-    else:
-        return {codes_date[j]: ({"label": codes_marks[codes_date[j]], "style": {"display": "none"}})
-                for j in sorted(df[df["Country"] == "Global"]["month_year"].unique())}
-
-
-@app.callback(
-    Output("date_slider", "className"),
-    [Input("country", "value")])
-def set_date_options(selected_country):
-    if not selected_country:
-        return "no_show"
-
-
-@app.callback(
+app.clientside_callback(
+    ClientsideFunction(namespace="spotify", function_name="popUp"),
     Output("popup_error", "className"),
     [Input("country", "value"),
-     Input("date_slider", "value"),
      Input("artist", "value"),
-     Input("song", "value")])
-def toggle_pop_up(selected_country, selected_date, selected_artist, selected_song):
-    if selected_date and selected_country and not selected_artist and not selected_song:
-        date_list = [date_codes[x] for x in range(selected_date[0], selected_date[1] + 1)]
-        if df.loc[(df["Country"] == selected_country) & (df["month_year"].isin(date_list))].empty:
-            return "show"
-    elif selected_date and selected_country and selected_artist and not selected_song:
-        date_list = [date_codes[x] for x in range(selected_date[0], selected_date[1] + 1)]
-        if df.loc[(df["Country"] == selected_country) & (df["Artist"] == selected_artist)
-                  & (df["month_year"].isin(date_list))].empty:
-            return "show"
-    elif selected_date and selected_country and selected_artist and selected_song:
-        date_list = [date_codes[x] for x in range(selected_date[0], selected_date[1] + 1)]
-        if df.loc[(df["Country"] == selected_country) & (df["Artist"] == selected_artist)
-                  & (df["Track Name"] == selected_song) & (df["month_year"].isin(date_list))].empty:
-            return "show"
-
-
-@app.callback(
-    Output("date_slider", "value"),
-    [Input("country", "value")])
-def set_date_values(selected_country):
-    if not selected_country:
-        selected_country = "Global"
-    return [codes_date[min(sorted(df[df["Country"] == selected_country]["month_year"].unique()))],
-            codes_date[max(sorted(df[df["Country"] == selected_country]["month_year"].unique()))]]
+     Input("song", "value"),
+     Input("date_slider", "value"),
+     Input("artist", "options"),
+     Input("song", "options"),
+     Input("chart_lookup", "data")])
 
 
 @app.callback(
     Output("artist", "options"),
     [Input("country", "value"),
-     Input("date_slider", "value")])
-def set_artist_options(selected_country, selected_date):
+     Input("date_slider", "value"),
+     Input("artist", "search_value")],
+    [State("artist", "value")])
+@metrics.instrument
+@memoize(chart_cache, version=data_version)
+def set_artist_options(selected_country, selected_date, search, selected_artist):
+    chart = store.current
     if selected_date:
-        date_list = [date_codes[x] for x in range(selected_date[0], selected_date[1] + 1)]
-        return [{"label": j, "value": j} for j in sorted(df[(df["Country"] == selected_country) &
-                                                            (df["month_year"].isin(date_list))]["Artist"].unique())]
+        start, end = selected_date
+        # The selected artists stay among the options, or the dropdown would not show them
+        artists = chart.cubes["country_artist"].search(start, end, (selected_country,), search, options_limit,
+                                                       selected_artist)
+        return [{"label": j, "value": j} for j in artists]
     else:
         return None
 
@@ -298,29 +389,40 @@ def set_artist_options(selected_country, selected_date):
     Output("song", "options"),
     [Input("country", "value"),
      Input("date_slider", "value"),
-     Input("artist", "value")])
-def set_song_options(selected_country, selected_date, selected_artist):
+     Input("artist", "value"),
+     Input("song", "search_value")],
+    [State("song", "value")])
+@metrics.instrument
+@memoize(chart_cache, version=data_version)
+def set_song_options(selected_country, selected_date, selected_artist, search, selected_song):
+    chart = store.current
     if selected_date:
-        date_list = [date_codes[x] for x in range(selected_date[0], selected_date[1] + 1)]
-        return [{"label": j, "value": j} for j in sorted(df[(df["Country"] == selected_country) &
-                                                            (df["Artist"] == selected_artist) &
-                                                            (df["month_year"].isin(date_list))]["Track Name"].unique())]
+        start, end = selected_date
+        songs = chart.cubes["country_track"].search(start, end, (selected_country, selection(selected_artist)),
+                                                    search, options_limit, selected_song)
+        return [{"label": j, "value": j} for j in songs]
     else:
         return None
 
 
+# A new country, range or artist clears the songs, or selects the song when a single artist with a single one is
+# selected. Apart from the options, so that searching the song dropdown keeps the selection.
 @app.callback(
     Output("song", "value"),
     [Input("country", "value"),
      Input("date_slider", "value"),
      Input("artist", "value")])
+@metrics.instrument
+@memoize(chart_cache, version=data_version)
 def set_song_value(selected_country, selected_date, selected_artist):
+    chart = store.current
     if selected_date:
-        date_list = [date_codes[x] for x in range(selected_date[0], selected_date[1] + 1)]
-        if len(df[(df["Country"] == selected_country) &
-                  (df["Artist"] == selected_artist) & (df["month_year"].isin(date_list))]["Track Name"].unique()) == 1:
-            return df[(df["Country"] == selected_country) &
-                      (df["Artist"] == selected_artist) & (df["month_year"].isin(date_list))]["Track Name"].unique()[0]
+        start, end = selected_date
+        artists = selection(selected_artist)
+        if len(artists) != 1:
+            return None
+        songs = chart.cubes["country_track"].members(start, end, selected_country, artists[0])
+        return [songs[0]] if len(songs) == 1 else None
     else:
         return None
 
@@ -328,6 +430,7 @@ def set_song_value(selected_country, selected_date, selected_artist):
 
 @app.callback(Output("country", "value"),
               [Input("choropleth_map", "clickData")])
+@metrics.instrument
 def change(jason):
     import json
     try:
@@ -340,44 +443,44 @@ def change(jason):
 # Building the plots
 
 
-@app.callback(Output("line_chart", "figure"),
-              [Input("country", "value"), Input("artist", "value"), Input("song", "value"),
-               Input("date_slider", "value")])
-def update_line_chart(country_filter, artists, songs, year_filter):
-    if not country_filter:
-        country_filter = "Global"
-    if not year_filter:
-        year_filter = [min(date_codes.keys()), max(date_codes.keys())]
-
-    date_list = [date_codes[x] for x in range(year_filter[0], year_filter[1] + 1)]
-    filtered_df = df[(df["Country"] == country_filter) & (df["month_year"].isin(date_list))]
-
-    if artists is None and songs is None:
-        filtered_df = filtered_df.groupby("month_year").agg({"Date": "first", "Streams": "sum"})
-
-    if artists is not None and songs is None:
-        filtered_df = filtered_df[filtered_df["Artist"] == artists]
-        filtered_df = filtered_df.groupby("month_year").agg({"Date": "first", "Streams": "sum"})
-
-    if artist is not None and songs is not None:
-        filtered_df = filtered_df[filtered_df["Artist"] == artists]
-        filtered_df = filtered_df[filtered_df["Track Name"] == songs]
-
-    # make sure to sort the values
-    filtered_df = filtered_df.sort_values(by=["Date"])
+# One request computes the line chart and the bar chart, so a filter change costs a single round trip. Like the
+# map, they are sent as patches of the graphs' figures: traces, title and margins, not the layout styling.
+# Several countries, artists or songs are compared: one line and one group of bars for each.
+@app.callback([Output("line_chart", "figure"), Output("bar_chart", "figure")],
+              [Input("country", "value"), Input("compare", "value"), Input("artist", "value"),
+               Input("song", "value"), Input("date_slider", "value")])
+@metrics.instrument
+@memoize(chart_cache, chart_filters, data_version)
+def update_charts(selected_country, compared_countries, selected_artist, selected_song, selected_date):
+    chart = store.current
+    countries = chart_countries(selected_country, compared_countries)
+    artists, songs = selection(selected_artist), selection(selected_song)
+    return (figures.patch(line_chart(chart, countries, artists, songs, selected_date), traces=True),
+            figures.patch(bar_chart(chart, countries, artists, songs, selected_date), traces=True))
+
+
+def line_chart(chart, countries, artists, songs, year_filter):
+    start, end = year_filter
+    level = timeseries.resolution(start, end, line_points)
+    by = [column for column, values in zip(FILTERS, [countries, artists, songs]) if len(values) > 1]
+    if by:
+        return compared_lines(chart, countries, artists, songs, year_filter, level, by)
+    country_filter, artists, songs = countries[0], (artists or [None])[0], (songs or [None])[0]
+    filtered_df = timeseries.rollup(chart.engine.series(country_filter, start, end, artists, songs), level,
+                                    line_points)
 
     def title(c, a, s, d):
         if c == "Global":
             c = "the world"
         top = 60
-        text_date = "<br> between " + codes_marks[d[0]] + " and " + codes_marks[d[1]]
+        text_date = "<br> between " + chart.codes_marks[d[0]] + " and " + chart.codes_marks[d[1]]
         if a is None and s is None:
             title_text = "Streams in " + str(c) + text_date
             return title_text, top
         elif a is not None and s is None:
             title_text = "Streams of " + str(a) + " in " + str(c) + text_date
             return title_text, top
-        elif a is not None and s is not None and c is not None:
+        else:
             if len(s) > 70:
                 blank_indices = [j for j, x in enumerate(s) if x == " "]
                 part_1 = min(blank_indices, key=lambda x: abs(x - len(s) / 3))
@@ -389,120 +492,111 @@ def update_line_chart(country_filter, artists, songs, year_filter):
                 middle = min(blank_indices, key=lambda x: abs(x - len(s) / 2))
                 s = s[:middle] + "<br>" + s[middle + 1:]
                 top = 85
-            title_text = "Streams of " + '"' + str(s) + '"' + "<br>" + " by " + str(a) + " in " + str(c) + text_date
+            # A song selected without an artist is summed over every artist with a song of that name
+            by = "" if a is None else "<br>" + " by " + str(a)
+            title_text = "Streams of " + '"' + str(s) + '"' + by + " in " + str(c) + text_date
             return title_text, top
 
-    data = [go.Scatter(dict(
-        y=filtered_df["Streams"],
-        x=filtered_df["Date"],
-        mode="lines",
-        line=dict(color="#1ED760", width=2))
-    )]
-    layout = dict(title=dict(text=title(country_filter, artists, songs, year_filter)[0], x=.5, y=.95,
-                             font={"size": 14}),
-                  xaxis=dict(title="Date", gridcolor="LightGrey", showline=True, linewidth=1.1,
-                             linecolor="rgb(89, 89, 89)", tickfont=dict(family="Arial", size=12)),
-                  yaxis=dict(title="Streams", gridcolor="LightGrey", tickfont=dict(family="Arial", size=12)),
-                  margin=dict(l=40, b=40, t=title(country_filter, artists, songs, year_filter)[1], r=40),
-                  legend=dict(x=1, y=1),
-                  paper_bgcolor="rgb(0,0,0,0)",
-                  plot_bgcolor="rgb(0,0,0,0)",
-                  height=450,
-                  )
-    fig = go.Figure(data=data, layout=layout)
-
-    return fig
+    title_text, top = title(country_filter, artists, songs, year_filter)
+    return figures.line(filtered_df["Date"], filtered_df["Streams"], title_text, top)
+
+
+# One line per compared value of the by columns (per combination when several are compared), in the order they were
+# selected. The series of all of them come from one grouped query over the slice.
+def compared_lines(chart, countries, artists, songs, year_filter, level, by):
+    start, end = year_filter
+    series = chart.engine.series(countries, start, end, artists or None, songs or None, by)
+    groups = dict(iter(timeseries.rollup(series, level, line_points, by).groupby(by, sort=False)))
+    selected = dict(zip(FILTERS, [countries, artists, songs]))
+    lines = []
+    for key in itertools.product(*[selected[column] for column in by]):
+        if key in groups:
+            lines.append((" - ".join(key), groups[key]["Date"], groups[key]["Streams"]))
+
+    top = 60
+    title_text = "Streams"
+    if songs:
+        title_text += " of " + listing(['"' + s + '"' for s in songs])
+        if artists:
+            title_text += "<br> by " + listing(artists)
+            top = 85
+    elif artists:
+        title_text += " of " + listing(artists)
+    title_text += " in " + listing(["the world" if c == "Global" else c for c in countries])
+    title_text += "<br> between " + chart.codes_marks[start] + " and " + chart.codes_marks[end]
+    return figures.lines(lines, title_text, top)
 
 
 @app.callback(
     Output("choropleth_map", "figure"),
     [Input("artist", "value"), Input("song", "value"), Input("date_slider", "value")])
+@metrics.instrument
+@memoize(chart_cache, map_filters, data_version)
 def update_choropleth_map(selected_artist, selected_song, selected_date):
-    dff = df.copy()
-    if not selected_date:
-        selected_date = [min(date_codes.keys()), max(date_codes.keys())]
+    chart = store.current
+    start, end = selected_date
+    artists, songs = selection(selected_artist), selection(selected_song)
 
-    date_list = [date_codes[x] for x in range(selected_date[0], selected_date[1] + 1)]
-    dff = dff[dff["month_year"].isin(date_list)]
+    # Compared artists and songs are shown together, with the streams of all of them in every country. Songs
+    # selected without an artist are summed over every artist, like the line chart does.
+    if not artists and not songs:
+        dff = chart.cubes["country"].totals(start, end)
 
-    if selected_artist is None and selected_song is None:
-        dff = dff.groupby(["iso_alpha", "Country"]).sum().reset_index()
+    if artists and not songs:
+        dff = chart.cubes["country_artist"].totals(start, end, {"Artist": artists})
 
-    if selected_artist is not None and selected_song is None:
-        dff = dff[dff["Artist"] == selected_artist]
-        dff = dff.groupby(["iso_alpha", "Country"]).sum().reset_index()
+    if songs:
+        where = {"Artist": artists, "Track Name": songs} if artists else {"Track Name": songs}
+        dff = chart.cubes["country_track"].totals(start, end, where)
 
-    if selected_artist is not None and selected_song is not None:
-        dff = df[df["Artist"] == selected_artist]
-        dff = dff[dff["Track Name"] == selected_song]
-        dff = dff.groupby(["iso_alpha", "Country"]).sum().reset_index()
+    if artists or songs:
+        dff = dff.groupby("Country", observed=True, as_index=False)["Streams"].sum()
+
+    dff["iso_alpha"] = dff["Country"].map(chart.country_iso)
+    dff = dff.dropna(subset=["iso_alpha"]).sort_values(by=["iso_alpha", "Country"])
 
     def title(a, s, d):
-        text_date = "<br> between " + codes_marks[d[0]] + " and " + codes_marks[d[1]]
-        if a is None and s is None:
+        text_date = "<br> between " + chart.codes_marks[d[0]] + " and " + chart.codes_marks[d[1]]
+        if not a and not s:
             return "Global streams of all songs" + text_date
-        if a is not None and s is None:
-            return "Global streams of " + str(a) + text_date
-        if a is not None and s is not None:
-            return "Global streams of" + "<br>" + '"' + str(s) + '"' + "<br>" + " by " + str(a) + text_date[4:]
-
-    trace = go.Choropleth(locations=dff["iso_alpha"], z=dff["Streams"], text=dff["Country"], autocolorscale=False,
-                          colorscale=[[0.0, "rgb(211, 248, 224)"],
-                                      [0.1111111111111111, "rgb(167, 241, 193)"],
-                                      [0.2222222222222222, "rgb(123, 234, 162)"],
-                                      [0.3333333333333333, "rgb(79, 227, 131)"],
-                                      [0.4444444444444444, "rgb(34, 221, 100)"],
-                                      [0.5555555555555556, "rgb(29, 185, 84)"],  # Spotify color
-                                      [0.6666666666666666, "rgb(24, 154, 70)"],
-                                      [0.7777777777777778, "rgb(17, 110, 50)"],
-                                      [0.8888888888888888, "rgb(10, 66, 30)"],
-                                      [1.0, "rgb(7, 44, 20)"]],
-                          marker={"line": {"color": "white", "width": 0.7}},
-                          colorbar={"thickness": 36, "len": 0.8, "outlinewidth": 0,
-                                    "title": {"text": "Number of <br> streams", "side": "bottom"}})
-    return {"data": [trace],
-            "layout": go.Layout(title=dict(text=title(selected_artist, selected_song, selected_date),
-                                           font={"size": 14}), height=450, margin=dict(l=0, b=0, t=80, r=100),
-                                geo={"showframe": False, "showcoastlines": False,
-                                     "projection": {"type": "equirectangular"}})}
-
-
-@app.callback(Output("bar_chart", "figure"),
-              [Input("country", "value"), Input("artist", "value"), Input("song", "value"),
-               Input("date_slider", "value")])
-def update_bar_chart(selected_country, selected_artist, selected_song, selected_date):
-    dff = df.copy()
-    if not selected_country:
-        selected_country = "Global"
-    if not selected_date:
-        selected_date = [min(date_codes.keys()), max(date_codes.keys())]
-
-    date_list = [date_codes[x] for x in range(selected_date[0], selected_date[1] + 1)]
+        if not s:
+            return "Global streams of " + listing(a) + text_date
+        if not a:
+            return "Global streams of" + "<br>" + listing(['"' + j + '"' for j in s]) + text_date
+        return ("Global streams of" + "<br>" + listing(['"' + j + '"' for j in s]) + "<br>" + " by " + listing(a) +
+                text_date[4:])
+
+    return figures.patch(figures.choropleth(dff["iso_alpha"], dff["Streams"], dff["Country"],
+                                            title(artists, songs, selected_date)))
+
+
+def bar_chart(chart, countries, artists, songs, selected_date):
+    if len(countries) > 1 or len(artists) > 1:
+        return compared_bars(chart, countries, artists, songs, selected_date)
+    selected_country, selected_artist = countries[0], (artists or [None])[0]
+    start, end = selected_date
 
     bar_color = "rgb(29, 185, 84)"
-    noartist = True
     left = 120
+    # The top 10 artists, or every song of the selected artist with the selected ones in grey
     if selected_artist is None:
-        dff = dff[(dff["Country"] == selected_country) & (dff["month_year"].isin(date_list))]
-        dff = dff.groupby(["Country", "Artist"])["Streams"].sum().reset_index()
+        names, streams = chart.cubes["country_artist"].top(start, end, (selected_country,), 10)
 
     if selected_artist is not None:
-        dff = dff[(dff["Artist"] == selected_artist) & (dff["Country"] == selected_country) &
-                  (dff["month_year"].isin(date_list))]
-        dff = dff.groupby(["Country", "Artist", "Track Name"])["Streams"].sum().reset_index()
-        noartist = False
-        if selected_song is not None:
-            dff = dff.sort_values(by=["Streams"], ascending=False)
-            if dff.shape[0] > 1:
-                bar_color = ["rgb(29, 185, 84)"]*(dff.shape[0]-1)
-                bar_color.insert(dff["Track Name"].tolist().index(selected_song), "rgb(89, 89, 89)")
+        cube = chart.cubes["country_track"]
+        names, streams = cube.top(start, end, (selected_country, selected_artist))
+        if songs:
+            if len(names) > 1:
+                bar_color = ["rgb(29, 185, 84)"] * len(names)
+                for song in songs:
+                    rank = cube.rank(start, end, (selected_country, selected_artist), song)
+                    if rank is not None:
+                        bar_color[rank] = "rgb(89, 89, 89)"
             else:
                 bar_color = "rgb(89, 89, 89)"
 
-    dff = dff.sort_values(by=["Streams"], ascending=False)
-
     def title(c, a, d):
-        text_date = "<br> between " + codes_marks[d[0]] + " and " + codes_marks[d[1]]
+        text_date = "<br> between " + chart.codes_marks[d[0]] + " and " + chart.codes_marks[d[1]]
         if a is None and c is not None:
             if c == "Global":
                 return "Top 10 artists in the world" + text_date
@@ -524,50 +618,32 @@ def update_bar_chart(selected_country, selected_artist, selected_song, selected_
 
             return str(a) + " song streams in " + str(c) + text_date
 
-    if noartist:
-        lenghts = [len(x) for x in dff["Artist"].head(10)]
-        if any([j > 50 for j in lenghts]):
-            left = 225
-        trace = go.Bar(
-            x=dff["Streams"].head(10),
-            y=dff["Artist"],
-            orientation="h",
-            marker=dict(
-                color="rgb(29, 185, 84)",
-                line=dict(
-                    color="rgb(29, 185, 84)",
-                    width=10)
-            ),
-            width=.05
-        )
+    if any(len(name) > 50 for name in names):
+        left = 225
+    return figures.bar(streams, names, bar_color, title(selected_country, selected_artist, selected_date), left)
+
+
+# Grouped bars, one per compared country: the top 10 artists over all of them, the selected artists, or the selected
+# songs of the selected artists, from one pivot of the rollups of every selected block
+def compared_bars(chart, countries, artists, songs, selected_date):
+    start, end = selected_date
+    where = listing(["the world" if c == "Global" else c for c in countries])
+    text_date = "<br> between " + chart.codes_marks[start] + " and " + chart.codes_marks[end]
+    if not artists:
+        table = chart.cubes["country_artist"].pivot(start, end, (countries,), 0, 10)
+        title_text = "Top 10 artists in " + where
+    elif not songs:
+        table = chart.cubes["country_artist"].pivot(start, end, (countries,), 0)
+        table = table[table.index.isin(artists)]
+        title_text = "Streams of " + listing(artists) + " in " + where
     else:
-        lenghts = [len(x) for x in dff["Track Name"]]
-        if any([j > 50 for j in lenghts]):
-            left = 225
-        trace = go.Bar(
-            x=dff["Streams"],
-            y=dff["Track Name"],
-            orientation="h",
-            marker=dict(
-                color=bar_color,
-                line=dict(
-                    color=bar_color,
-                    width=10)
-            ),
-            width=.05
-        )
-    data = [trace]
-    layout = dict(title=dict(text=title(selected_country, selected_artist, selected_date), x=.5, font={"size": 14}),
-                  xaxis=dict(title="Number of streams", gridcolor="LightGrey", showline=True,
-                             linecolor="rgb(89, 89, 89)", tickfont=dict(family="Arial", size=12)),
-                  yaxis=dict(gridcolor="LightGrey", tickfont=dict(family="Arial", size=10),
-                             autorange="reversed"),
-                  margin=dict(l=left, b=40, t=50, r=100),
-                  paper_bgcolor="rgb(0,0,0,0)",
-                  plot_bgcolor="rgb(0,0,0,0)",
-                  )
-    fig = go.Figure(data=data, layout=layout)
-    return fig
+        table = chart.cubes["country_track"].pivot(start, end, (countries, artists), 0)
+        table = table[table.index.isin(songs)]
+        title_text = "Streams of " + listing(['"' + s + '"' for s in songs]) + " in " + where
+    names = table.index.tolist()
+    left = 225 if any(len(name) > 50 for name in names) else 120
+    return figures.bars([(country, table[country].to_numpy()) for country in countries], names,
+                        title_text + text_date, left)
 
 
 if __name__ == "__main__":
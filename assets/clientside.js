@@ -0,0 +1,67 @@
+"use strict";
+
+// Clientside callbacks of app.py. They only format and look up values in the table of the chart_lookup store
+// (built by clientside.py) and in the dropdown options, so they run in the browser without a round trip to the
+// server.
+
+(function () {
+    // Whether value is among the options of a dropdown
+    function listed(options, value) {
+        return options.some(function (o) { return o.value === value; });
+    }
+
+    window.dash_clientside = Object.assign({}, window.dash_clientside, {
+        spotify: {
+            // A new country clears the artist and resets the slider to the months with data for that country
+            countryFilters: function (country, lookup) {
+                var months = lookup.countries[country || "Global"].months;
+                var marks = {};
+                months.forEach(function (j) {
+                    marks[j] = country && [0, 12, 24].indexOf(j) >= 0 ? {label: lookup.labels[j]}
+                        : {label: lookup.labels[j], style: {display: "none"}};
+                });
+                return [null, marks, country ? null : "no_show", [months[0], months[months.length - 1]]];
+            },
+
+            sliderLabel: function (value, lookup) {
+                if (value) {
+                    return "From " + lookup.labels[value[0]] + " to " + lookup.labels[value[1]];
+                }
+                return null;
+            },
+
+            // The "no data" popup, shown when none of the selected artists and songs has chart rows in the selected
+            // country and range. The artist and song dropdowns are multi-select and give lists.
+            popUp: function (selectedCountry, artist, song, date, artistOptions, songOptions, lookup) {
+                var country = selectedCountry || "Global";
+                var range = date || [0, lookup.labels.length - 1];
+                var artists = [].concat(artist || []);
+                var songs = [].concat(song || []);
+                if (songs.length && !artists.length) {
+                    return null;
+                }
+                if (!lookup.countries[country]) {
+                    return "show";
+                }
+                if (!artists.length) {
+                    var any = lookup.countries[country].months.some(function (m) {
+                        return m >= range[0] && m <= range[1];
+                    });
+                    return any ? null : "show";
+                }
+                // The options keep the selected artists and songs that have rows in the selected country and range
+                // (there are none without a country, while the charts fall back to the world)
+                if (!selectedCountry) {
+                    return null;
+                }
+                if (artistOptions && !artists.some(function (a) { return listed(artistOptions, a); })) {
+                    return "show";
+                }
+                if (songs.length && songOptions && !songs.some(function (s) { return listed(songOptions, s); })) {
+                    return "show";
+                }
+                return null;
+            }
+        }
+    });
+})();
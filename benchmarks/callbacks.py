@@ -0,0 +1,86 @@
+import argparse
+import importlib
+import os
+import random
+import time
+
+import numpy as np
+
+# Calls the Dash callbacks of app.py directly with a realistic mix of filter states and reports their latency:
+#   python -m benchmarks.callbacks --csv data/synthetic_month.csv [--requests 500] [--cache]
+# Without --cache the output cache is disabled, so every call does the full work.
+
+
+def input_mix(chart, requests, seed=0):
+    rng = random.Random(seed)
+    first, last = chart.full_range
+    for _ in range(requests):
+        # Most sessions stay on the world view and the full range
+        country = "Global" if rng.random() < 0.4 else rng.choice(chart.av_country)
+        if rng.random() < 0.5:
+            date = [first, last]
+        else:
+            start = rng.randint(first, last - 1)
+            date = [start, rng.randint(start + 1, last)]
+        artist = song = compare = None
+        artists = chart.cubes["country_artist"].members(date[0], date[1], country)
+        if len(artists) and rng.random() < 0.5:
+            artist = rng.choice(list(artists))
+            songs = chart.cubes["country_track"].members(date[0], date[1], country, artist)
+            if len(songs) and rng.random() < 0.5:
+                song = rng.choice(list(songs))
+        # Some sessions compare up to five artists or up to three more countries
+        if len(artists) > 1 and song is None and rng.random() < 0.1:
+            artist = rng.sample(list(artists), min(len(artists), rng.randint(2, 5)))
+        if rng.random() < 0.1:
+            compare = rng.sample(chart.av_country, min(len(chart.av_country), rng.randint(1, 3)))
+        yield country, compare, date, artist, song
+
+
+def callbacks(app):
+    return {
+        "set_artist_options": lambda c, o, d, a, s: app.set_artist_options(c, d, None, a),
+        "set_song_options": lambda c, o, d, a, s: app.set_song_options(c, d, a, None, s),
+        "set_song_value": lambda c, o, d, a, s: app.set_song_value(c, d, a),
+        "update_charts": lambda c, o, d, a, s: app.update_charts(c, o, a, s, d),
+        "update_choropleth_map": lambda c, o, d, a, s: app.update_choropleth_map(a, s, d),
+    }
+
+
+def report(name, timings):
+    timings = np.array(timings) * 1000
+    print("{:<24} {:>7} {:>10.3f} {:>10.3f} {:>10.3f} {:>10.3f}".format(
+        name, len(timings), timings.mean(), np.percentile(timings, 50), np.percentile(timings, 99), timings.max()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-benchmarks of the app.py callbacks")
+    parser.add_argument("--csv", default=os.environ.get("CHART_CSV", "data/spotify_month.csv"))
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--cache", action="store_true", help="keep the output cache enabled")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    os.environ["CHART_CSV"] = args.csv
+    if not args.cache:
+        os.environ["CHART_CACHE_SIZE"] = "0"
+    started = time.perf_counter()
+    app = importlib.import_module("app")
+    chart = app.store.current
+    print("Loaded {} rows, {} countries, {} months in {:.2f}s".format(
+        len(chart.engine), len(chart.av_country), len(chart.months_years), time.perf_counter() - started))
+
+    mix = list(input_mix(chart, args.requests, args.seed))
+    print("{:<24} {:>7} {:>10} {:>10} {:>10} {:>10}".format("callback", "calls", "mean ms", "p50 ms", "p99 ms",
+                                                           "max ms"))
+    for name, call in callbacks(app).items():
+        timings = []
+        for inputs in mix:
+            call_started = time.perf_counter()
+            call(*inputs)
+            timings.append(time.perf_counter() - call_started)
+        report(name, timings)
+
+
+if __name__ == "__main__":
+    main()
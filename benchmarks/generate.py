@@ -0,0 +1,70 @@
+import argparse
+import calendar
+import csv
+import os
+
+import numpy as np
+
+from data import read_country_codes
+
+# Writes synthetic chart data shaped like data/spotify_month.csv: one top chart per country and month (or per
+# day with daily=True), with Zipf-like popularity so a few artists and tracks dominate, as in the real charts.
+
+
+def month_list(first_year, months):
+    return ["{}-{:02d}".format(first_year + i // 12, i % 12 + 1) for i in range(months)]
+
+
+def chart_days(month, daily):
+    if not daily:
+        return [month + "-01"]
+    days = calendar.monthrange(int(month[:4]), int(month[5:]))[1]
+    return ["{}-{:02d}".format(month, day) for day in range(1, days + 1)]
+
+
+def generate(path, countries=20, months=25, artists=2000, tracks=10, chart_size=200, first_year=2017, seed=0,
+             daily=False):
+    rng = np.random.default_rng(seed)
+    names = ["Global"] + sorted(read_country_codes())[:countries - 1]
+    artist_weight = 1 / np.arange(1, artists + 1) ** 1.1
+    artist_weight /= artist_weight.sum()
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["Position", "Track Name", "Artist", "Streams", "Track URL", "Date", "Country", "month_year"])
+        for country_number, country in enumerate(names):
+            # Smaller markets join the charts later, like in the real data
+            joined = 0 if country_number < countries // 2 else int(rng.integers(0, months // 2 + 1))
+            scale = 10 ** rng.uniform(5, 7) if country != "Global" else 10 ** 8
+            for month in month_list(first_year, months)[joined:]:
+                for date in chart_days(month, daily):
+                    chart_artists = rng.choice(artists, size=chart_size, p=artist_weight)
+                    chart_tracks = rng.zipf(1.6, size=chart_size) % tracks
+                    streams = np.sort(scale / np.arange(1, chart_size + 1) ** 0.8 * rng.uniform(0.8, 1.2, chart_size))
+                    for position in range(chart_size):
+                        artist_name = "Artist {}".format(chart_artists[position])
+                        track = "{} - Track {}".format(artist_name, chart_tracks[position])
+                        writer.writerow([position + 1, track, artist_name, int(streams[-position - 1]),
+                                         "https://open.spotify.com/track/{}x{}".format(chart_artists[position],
+                                                                                       chart_tracks[position]),
+                                         date, country, month])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate synthetic Spotify chart data")
+    parser.add_argument("path", nargs="?", default="data/synthetic_month.csv")
+    parser.add_argument("--countries", type=int, default=20)
+    parser.add_argument("--months", type=int, default=25)
+    parser.add_argument("--artists", type=int, default=2000)
+    parser.add_argument("--tracks", type=int, default=10, help="tracks per artist")
+    parser.add_argument("--chart-size", type=int, default=200, help="chart rows per country and month")
+    parser.add_argument("--daily", action="store_true", help="one chart per country and day")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    generate(args.path, args.countries, args.months, args.artists, args.tracks, args.chart_size, seed=args.seed,
+             daily=args.daily)
+    print("Wrote " + args.path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from benchmarks.callbacks import input_mix
+from prerender import request_bodies
+
+# HTTP load driver for the Dash endpoint: replays the callback requests a browser sends for a mix of filter
+# states against a running server, and reports latency percentiles and throughput.
+#   python -m benchmarks.load --url http://127.0.0.1:8000 [--concurrency 8] [--duration 30]
+#   python -m benchmarks.load --spawn "--workers 4" --csv data/synthetic_month.csv
+
+
+def post(url, body):
+    request = urllib.request.Request(url + "/_dash-update-component", data=json.dumps(body).encode(),
+                                     headers={"Content-Type": "application/json", "Accept-Encoding": "gzip"})
+    started = time.perf_counter()
+    with urllib.request.urlopen(request) as response:
+        size = len(response.read())
+    return time.perf_counter() - started, size
+
+
+def wait_for(url, timeout=120):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with urllib.request.urlopen(url + "/_dash-dependencies"):
+                return
+        except OSError:
+            time.sleep(0.5)
+    raise RuntimeError("No server at " + url)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="HTTP load test of /_dash-update-component")
+    parser.add_argument("--url", default="http://127.0.0.1:8000")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument("--spawn", metavar="GUNICORN_ARGS",
+                        help="start gunicorn app:server with these extra arguments for the run")
+    parser.add_argument("--csv", help="CHART_CSV of the spawned server")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    server = None
+    if args.spawn is not None:
+        env = dict(os.environ, **({"CHART_CSV": args.csv} if args.csv else {}))
+        bind = args.url.split("://", 1)[-1]
+        server = subprocess.Popen([sys.executable, "-m", "gunicorn", "app:server", "--bind", bind] + args.spawn.split(),
+                                  env=env)
+    try:
+        wait_for(args.url)
+        with urllib.request.urlopen(args.url + "/_dash-dependencies") as response:
+            dependencies = json.load(response)
+        # The filter states come from the same data as the server's, loaded locally
+        os.environ.setdefault("CHART_CSV", args.csv or "data/spotify_month.csv")
+        from app import store
+        bodies = [body for country, compare, date, artist, song in input_mix(store.current, 1000, args.seed)
+                  for body in request_bodies(dependencies, {"country": country, "compare": compare,
+                                                            "date_slider": date, "artist": artist, "song": song,
+                                                            "choropleth_map": None})]
+
+        timings, sizes, errors = [], [], []
+        lock = threading.Lock()
+        deadline = time.time() + args.duration
+
+        def worker(offset):
+            i = offset
+            while time.time() < deadline:
+                try:
+                    elapsed, size = post(args.url, bodies[i % len(bodies)])
+                    with lock:
+                        timings.append(elapsed)
+                        sizes.append(size)
+                except Exception as e:
+                    with lock:
+                        errors.append(e)
+                i += args.concurrency
+
+        started = time.time()
+        with ThreadPoolExecutor(args.concurrency) as pool:
+            list(pool.map(worker, range(args.concurrency)))
+        elapsed = time.time() - started
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    timings = np.array(timings) * 1000
+    print("requests {}  errors {}  throughput {:.1f} req/s".format(len(timings), len(errors), len(timings) / elapsed))
+    if len(timings):
+        print("latency ms  p50 {:.2f}  p90 {:.2f}  p99 {:.2f}  max {:.2f}".format(
+            *np.percentile(timings, [50, 90, 99]), timings.max()))
+        print("response bytes  mean {:.0f}".format(np.mean(sizes)))
+
+
+if __name__ == "__main__":
+    main()
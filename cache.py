@@ -0,0 +1,159 @@
+import functools
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+import metrics
+from figures import dumps
+
+
+# In-process LRU store of serialized callback outputs, bounded by entry count and by total bytes
+class LRUCache:
+    def __init__(self, max_entries=1024, max_bytes=64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            if key in self.entries:
+                self.size -= len(self.entries.pop(key))
+            self.entries[key] = value
+            self.size += len(value)
+            while self.entries and (len(self.entries) > self.max_entries or self.size > self.max_bytes):
+                self.size -= len(self.entries.popitem(last=False)[1])
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self.entries), "bytes": self.size}
+
+
+# Store shared by every gunicorn worker on the host: one file per entry, the file's mtime is its last use.
+# Each worker keeps a running count of the entries and bytes in the directory: its own writes are added as they
+# happen, and the directory is only scanned again (and the least recently used entries removed, down to 90% of
+# max_bytes) when the count goes over max_bytes or every rescan writes, which picks up the writes of the others.
+class FileCache:
+    def __init__(self, directory, max_bytes=256 * 1024 * 1024, rescan=256):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.rescan = rescan
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.writes = 0
+        self.entries, self.size = 0, 0
+        self.evict()
+
+    def path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode()).hexdigest() + ".json")
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            with open(path, "rb") as f:
+                value = f.read()
+            os.utime(path)
+        except OSError:
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+        return value
+
+    def set(self, key, value):
+        path = self.path(key)
+        try:
+            replaced = os.stat(path).st_size
+        except OSError:
+            replaced = None
+        # Write to a temporary file and rename it, so other workers never read a half written entry
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(value)
+        os.replace(tmp, path)
+        with self.lock:
+            self.entries += replaced is None
+            self.size += len(value) - (replaced or 0)
+            self.writes += 1
+            full = self.size > self.max_bytes or self.writes % self.rescan == 0
+        if full:
+            self.evict()
+
+    def evict(self):
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".json"):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        size, entries = sum(f[1] for f in files), len(files)
+        if size > self.max_bytes:
+            for _, file_size, path in sorted(files):
+                if size <= self.max_bytes * 0.9:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                size -= file_size
+                entries -= 1
+        with self.lock:
+            self.entries, self.size = entries, size
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": self.entries, "bytes": self.size}
+
+
+# CHART_CACHE_DIR switches from a private per-worker cache to the shared file store
+def make_cache():
+    max_bytes = int(os.environ.get("CHART_CACHE_BYTES", 64 * 1024 * 1024))
+    if os.environ.get("CHART_CACHE_DIR"):
+        return FileCache(os.environ["CHART_CACHE_DIR"], max_bytes)
+    return LRUCache(int(os.environ.get("CHART_CACHE_SIZE", 1024)), max_bytes)
+
+
+def freeze(value):
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(v) for v in value)
+    return value
+
+
+# Caches the JSON of a callback's output under its normalized inputs and, when given, the version of the
+# data. A hit only decodes that JSON, so it skips the data work as well as building and encoding the figure.
+def memoize(cache, normalize=None, version=None):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args):
+            inputs = normalize(*args) if normalize else args
+            key = repr((func.__name__, version() if version else None, freeze(inputs)))
+            value = cache.get(key)
+            metrics.note(cache="hit" if value is not None else "miss")
+            if value is None:
+                value = dumps(func(*inputs)).encode()
+                cache.set(key, value)
+            metrics.note(bytes=len(value))
+            return json.loads(value)
+        return wrapper
+    return decorator
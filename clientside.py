@@ -0,0 +1,14 @@
+import functools
+
+# Lookup table for the clientside callbacks in assets/clientside.js, emitted once in the layout: the month labels
+# and the months with data per country. It grows with the countries and months only; whether the selected artists
+# and songs have rows in the selected range is read from the dropdown options, which always keep those that do.
+
+
+@functools.lru_cache(maxsize=1)
+def lookup(chart):
+    return {
+        "labels": [chart.codes_marks[j] for j in range(len(chart.months_years))],
+        "countries": {country: {"months": [int(j) for j in chart.cubes["country"].months(country)]}
+                      for country in chart.av_country},
+    }
@@ -0,0 +1,31 @@
+import gzip
+
+from flask import request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Compresses the JSON responses (callback outputs, layout, dependencies) for clients that accept it: with brotli
+# when the brotli package is installed, with gzip otherwise. Figure payloads are mostly repeated keys and base64
+# digits and shrink several times.
+
+
+def register(server, level=6, min_size=1024):
+    @server.after_request
+    def compress(response):
+        if (response.status_code != 200 or response.direct_passthrough or response.mimetype != "application/json"
+                or "Content-Encoding" in response.headers):
+            return response
+        data = response.get_data()
+        if len(data) < min_size:
+            return response
+        if brotli is not None and request.accept_encodings["br"]:
+            response.set_data(brotli.compress(data, quality=level))
+            response.headers["Content-Encoding"] = "br"
+        elif request.accept_encodings["gzip"]:
+            response.set_data(gzip.compress(data, level))
+            response.headers["Content-Encoding"] = "gzip"
+        response.vary.add("Accept-Encoding")
+        return response
@@ -0,0 +1,330 @@
+import csv
+import hashlib
+import json
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+from aggregates import Cube, build_cubes
+from engine import PandasEngine
+
+# Columns the callbacks read; everything else in the chart files is dropped once cleaning is done
+CATEGORY_COLUMNS = ["Country", "Artist", "Track Name", "Date", "iso_alpha"]
+# Bundled country name -> ISO-3 table (from plotly's gapminder_with_codes.csv), so startup needs no network
+COUNTRY_CODES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "country_codes.csv")
+
+logger = logging.getLogger(__name__)
+
+
+def read_country_codes(path=COUNTRY_CODES):
+    with open(path, newline="") as f:
+        rows = csv.DictReader(line for line in f if not line.startswith("#"))
+        return {row["country"]: row["iso_alpha"] for row in rows}
+
+
+# Parses and cleans a Spotify Charts export; the result still has month_year as strings. Returns the rows kept by
+# the duplicate filter and the rows it dropped.
+def read_chart_csv(path):
+    return split_repeated(read_chart_rows(path))
+
+
+# Key of the duplicate filter for every row: a 64-bit hash of its Track URL and Country
+def chart_keys(df):
+    return pd.util.hash_array((df["Track URL"] + df["Country"]).to_numpy(dtype=object))
+
+
+# Only keep cases where we have data for multiple months: the rows whose key appears more than once. Returns them
+# and the other rows, with the key of each in "key".
+def split_repeated(df):
+    df = df.assign(key=chart_keys(df))
+    repeated = df["key"].duplicated(keep=False).to_numpy()
+    return df[repeated], df[~repeated]
+
+
+# The rows of a chart file without missing values, with their map codes
+def read_chart_rows(path):
+    df = pd.read_csv(path)
+    df = df.dropna()
+    df["iso_alpha"] = df["Country"].map(read_country_codes())
+    return df
+
+
+# Countries of the chart table without an ISO-3 code, which the choropleth cannot draw ("Global" has none)
+def missing_country_codes(df):
+    countries = df.loc[df["iso_alpha"].isna(), "Country"].unique()
+    return sorted(c for c in countries if c != "Global")
+
+
+# Dictionary-encodes the cleaned chart table: the string columns become pandas categoricals (sorted
+# dictionary + small integer codes) and month_year is replaced by month_code, the integer RangeSlider
+# index, so filters are integer comparisons instead of string comparisons over every row.
+def encode(df, codes_date):
+    out = pd.DataFrame({column: pd.Categorical(df[column]) for column in CATEGORY_COLUMNS})
+    out["Streams"] = df["Streams"].to_numpy(dtype=np.int64)
+    out["month_code"] = df["month_year"].map(codes_date).to_numpy(dtype=np.int16)
+    return out
+
+
+# Encodes the rows dropped by the duplicate filter. They keep month_year (as a categorical) instead of a slider
+# code, since their months may not be in the table, and their key, since a later chart file can revive them.
+def encode_singles(df):
+    out = pd.DataFrame({column: pd.Categorical(df[column]) for column in CATEGORY_COLUMNS + ["month_year"]})
+    out["Streams"] = df["Streams"].to_numpy(dtype=np.int64)
+    out["key"] = df["key"].to_numpy(dtype=np.uint64)
+    return out
+
+
+# The rows of encode_singles() as read_chart_rows returns them
+def decode_singles(singles):
+    out = pd.DataFrame({column: singles[column].to_numpy(dtype=object) for column in CATEGORY_COLUMNS + ["month_year"]})
+    out["Streams"] = singles["Streams"].to_numpy()
+    out["key"] = singles["key"].to_numpy()
+    return out
+
+
+# Encoded frames with the same columns one after the other, their categoricals over the union of the dictionaries
+def concat_encoded(frames):
+    columns = {}
+    for column in frames[0].columns:
+        if isinstance(frames[0][column].dtype, pd.CategoricalDtype):
+            columns[column] = union_categoricals([frame[column].array for frame in frames], sort_categories=True)
+        else:
+            columns[column] = np.concatenate([frame[column].to_numpy() for frame in frames])
+    return pd.DataFrame(columns)
+
+
+def snapshot_file(directory, column):
+    return os.path.join(directory, column.lower().replace(" ", "_") + ".npy")
+
+
+def cube_file(directory, cube, array):
+    return os.path.join(directory, "cubes", cube, array + ".npy")
+
+
+def save_array(path, array):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", "wb") as f:
+        np.save(f, array)
+    os.replace(path + ".tmp", path)
+
+
+# Writes the columns of an encoded frame as one .npy file each (the codes of the categoricals) and returns the
+# string dictionaries of the categoricals
+def write_columns(df, directory):
+    categories = {}
+    for column in df.columns:
+        if isinstance(df[column].dtype, pd.CategoricalDtype):
+            categories[column] = df[column].cat.categories.tolist()
+            save_array(snapshot_file(directory, column), df[column].cat.codes.to_numpy())
+        else:
+            save_array(snapshot_file(directory, column), df[column].to_numpy())
+    return categories
+
+
+# Version of the snapshot files; snapshots of another version are ignored and the CSV is parsed instead
+SNAPSHOT_FORMAT = 2
+
+
+# Writes the encoded table as one .npy file per column, the arrays of the cubes built from it (their key codes
+# into the same string dictionaries) in cubes/, the history of the duplicate filter (the kept keys in seen.npy and
+# the dropped rows in singles/), and meta.json holding the string dictionaries and the month list. Files are
+# written next to their final name and renamed last, meta.json at the very end, so a running app never sees a
+# half written snapshot.
+def write_snapshot(df, months_years, directory, source, cubes, history):
+    os.makedirs(directory, exist_ok=True)
+    meta = {"format": SNAPSHOT_FORMAT, "rows": len(df), "months": list(months_years), "cubes": {},
+            "source": os.path.basename(source) if source else None}
+    meta["categories"] = write_columns(df, directory)
+    seen, singles = history
+    save_array(os.path.join(directory, "seen.npy"), seen)
+    meta["singles"] = {"columns": list(singles.columns),
+                       "categories": write_columns(singles, os.path.join(directory, "singles"))}
+    for name, cube in cubes.items():
+        for level, column in enumerate(cube.names):
+            codes = df[column].cat.categories.get_indexer(cube.categories[level])[cube.codes[level]]
+            save_array(cube_file(directory, name, "codes_{}".format(level)), codes.astype(cube.codes[level].dtype))
+        save_array(cube_file(directory, name, "cells"), cube.cells)
+        save_array(cube_file(directory, name, "cumulative"), cube.cumulative)
+        for i, (permutation, _, _) in enumerate(cube.orders.values()):
+            save_array(cube_file(directory, name, "order_{}".format(i)), permutation)
+        meta["cubes"][name] = {"columns": cube.names, "orders": [list(columns) for columns in cube.orders]}
+    with open(os.path.join(directory, "meta.json.tmp"), "w") as f:
+        json.dump(meta, f)
+    os.replace(os.path.join(directory, "meta.json.tmp"), os.path.join(directory, "meta.json"))
+
+
+# Memory-maps a snapshot: the pages of the columns and of the cubes live in the OS page cache and are shared by
+# every worker, which neither parses the CSV nor builds the cubes. Returns the table, its months, the cubes and the
+# history of the duplicate filter, or None for a snapshot of another format.
+def read_snapshot(directory):
+    with open(os.path.join(directory, "meta.json")) as f:
+        meta = json.load(f)
+    if meta.get("format") != SNAPSHOT_FORMAT:
+        return None
+    categories = {column: pd.Index(values) for column, values in meta["categories"].items()}
+    columns = {}
+    for column in CATEGORY_COLUMNS:
+        codes = np.load(snapshot_file(directory, column), mmap_mode="r")
+        columns[column] = pd.Categorical.from_codes(codes, dtype=pd.CategoricalDtype(categories[column]))
+    for column in ["Streams", "month_code"]:
+        columns[column] = np.load(snapshot_file(directory, column), mmap_mode="r")
+    def array(cube, kind):
+        return np.load(cube_file(directory, cube, kind), mmap_mode="r")
+
+    cubes = {}
+    for name, spec in meta["cubes"].items():
+        cubes[name] = Cube(spec["columns"],
+                           [array(name, "codes_{}".format(level)) for level in range(len(spec["columns"]))],
+                           [categories[column] for column in spec["columns"]], len(meta["months"]),
+                           array(name, "cells"), array(name, "cumulative"),
+                           {tuple(columns): array(name, "order_{}".format(i))
+                            for i, columns in enumerate(spec["orders"])})
+    singles = {}
+    for column in meta["singles"]["columns"]:
+        values = np.load(snapshot_file(os.path.join(directory, "singles"), column), mmap_mode="r")
+        if column in meta["singles"]["categories"]:
+            values = pd.Categorical.from_codes(values, categories=meta["singles"]["categories"][column])
+        singles[column] = values
+    history = np.load(os.path.join(directory, "seen.npy"), mmap_mode="r"), pd.DataFrame(singles, copy=False)
+    return pd.DataFrame(columns, copy=False), meta["months"], cubes, history
+
+
+def snapshot_is_current(csv_path, directory):
+    meta = os.path.join(directory, "meta.json")
+    if not os.path.exists(meta):
+        return False
+    with open(meta) as f:
+        source = json.load(f).get("source")
+    if source and source != os.path.basename(csv_path):
+        return False
+    return not os.path.exists(csv_path) or os.path.getmtime(meta) >= os.path.getmtime(csv_path)
+
+
+# Names the chart data read from paths (their names, sizes and modification times) and the version code of the code
+# that turns it into callback outputs, e.g. for cache entries that outlive the process. Missing paths are skipped.
+def source_version(paths, code=""):
+    digest = hashlib.sha1(code.encode())
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        digest.update("{}\0{}\0{}\n".format(os.path.basename(path), stat.st_size, stat.st_mtime_ns).encode())
+    return digest.hexdigest()[:12]
+
+
+# Returns the encoded chart table, its sorted months and the history of the duplicate filter: the sorted keys of
+# the kept rows and the encoded rows it dropped
+def parse(csv_path):
+    df, singles = read_chart_csv(csv_path)
+    months_years = sorted(df["month_year"].unique())
+    history = np.unique(df["key"].to_numpy()), encode_singles(singles)
+    return encode(df, {v: k for k, v in enumerate(months_years)}), months_years, history
+
+
+# Reads the snapshot written by ingest.py when it is at least as recent as the CSV, and parses the CSV otherwise.
+# Returns the table, its months, its cubes (None when they still need to be built) and the history of the
+# duplicate filter.
+def load(csv_path, directory):
+    snapshot = read_snapshot(directory) if snapshot_is_current(csv_path, directory) else None
+    if snapshot is not None:
+        df, months_years, cubes, history = snapshot
+    else:
+        df, months_years, history = parse(csv_path)
+        cubes = None
+    missing = missing_country_codes(df)
+    if missing:
+        logger.warning("No ISO-3 code for %s, they are left out of the map", ", ".join(missing))
+    return df, months_years, cubes, history
+
+
+month_dict = {1: "Jan", 2: "Feb", 3: "Mar", 4: "Apr", 5: "May", 6: "Jun", 7: "Jul", 8: "Aug", 9: "Sep", 10: "Oct",
+              11: "Nov", 12: "Dec"}
+
+
+# Slider labels ("Jan-2018", ...) of the "YYYY-MM" months
+def month_marks(months_years):
+    codes_marks = {}
+    for i in range(len(months_years)):
+        if months_years[i][5] == "0":  # January to September
+            text = month_dict[int(months_years[i][6])]
+        else:  # October to December
+            text = month_dict[int(months_years[i][-2:])]
+        text += ("-" + months_years[i][:4])
+        codes_marks[i] = text
+    return codes_marks
+
+
+# The encoded chart table together with everything the callbacks derive from it. It is never modified:
+# append() returns a new ChartData, which the store swaps in while running callbacks keep the old one.
+# The rows are queried through engine: PandasEngine over df, or an engine over a database when df is None.
+# history is what append() needs of the duplicate filter, as parse() returns it.
+class ChartData:
+    def __init__(self, df, months_years, cubes=None, country_iso=None, version="", engine=None, history=None):
+        self.df = df
+        self.history = history
+        self.engine = engine if engine is not None else PandasEngine(df)
+        self.months_years = list(months_years)
+        self.version = version
+        # Dictionaries to use for the year range slider
+        self.date_codes = dict(enumerate(self.months_years))
+        self.codes_date = {v: k for k, v in self.date_codes.items()}
+        self.codes_marks = month_marks(self.months_years)
+        # Monthly stream rollups with running sums over the slider codes, used by the map and the bar chart
+        self.cubes = cubes if cubes is not None else self.engine.cubes(len(self.date_codes))
+        self.country_iso = country_iso if country_iso is not None else self.engine.country_iso()
+        self.artist = self.engine.categories("Artist")
+        self.song = self.engine.categories("Track Name")
+        self.av_country = self.engine.categories("Country")
+
+    @property
+    def full_range(self):
+        return [min(self.date_codes.keys()), max(self.date_codes.keys())]
+
+    # Adds the rows of new chart files (from read_chart_rows), as if they had been parsed together with the files
+    # loaded so far. Only the new rows are encoded and rolled up; the existing rows are recoded with integer
+    # lookups and the cubes are merged. Countries and months already loaded are skipped, so appending the same
+    # file twice changes nothing.
+    def append(self, new, version):
+        if self.df is None:
+            raise RuntimeError("Appending chart files needs the table in memory; rebuild the database instead")
+        if self.history is None:
+            raise RuntimeError("Appending chart files needs the history of the duplicate filter from parse()")
+        seen, singles = self.history
+        # Countries and months of the rows so far, kept or dropped by the duplicate filter
+        country = self.cubes["country"]
+        (codes,), months, _ = country.unpack()
+        loaded = pd.MultiIndex.from_arrays([
+            np.concatenate([country.labels(0, codes), singles["Country"].to_numpy(dtype=object)]),
+            np.concatenate([np.asarray(self.months_years, dtype=object)[months],
+                            singles["month_year"].to_numpy(dtype=object)])])
+        new = new[~pd.MultiIndex.from_frame(new[["Country", "month_year"]]).isin(loaded)]
+        if new.empty:
+            return self
+        # The duplicate filter of read_chart_csv over the rows so far and the new ones: a new row is kept when its
+        # key was kept before, was dropped before (that dropped row is added too) or appears more than once in
+        # the new rows. The other new rows are dropped until a later file repeats their key.
+        new = new.assign(key=chart_keys(new))
+        keys = new["key"].to_numpy()
+        revived = np.isin(singles["key"].to_numpy(), keys)
+        kept = np.isin(keys, seen) | np.isin(keys, singles["key"].to_numpy()) | new["key"].duplicated(keep=False)
+        history = np.union1d(seen, keys[kept]), concat_encoded([singles[~revived], encode_singles(new[~kept])])
+        new = pd.concat([new[kept], decode_singles(singles[revived])], ignore_index=True)
+        if new.empty:
+            return ChartData(self.df, self.months_years, self.cubes, self.country_iso, self.version, self.engine,
+                             history)
+
+        months_years = sorted(set(self.months_years) | set(new["month_year"]))
+        codes_date = {v: k for k, v in enumerate(months_years)}
+        new = encode(new, codes_date)
+        old_codes = np.array([codes_date[m] for m in self.months_years], dtype=np.int16)
+        df = concat_encoded([self.df.assign(month_code=old_codes[self.df["month_code"].to_numpy()]), new])
+
+        new_cubes = build_cubes(new, len(months_years))
+        cubes = {name: cube.merge(new_cubes[name], len(months_years), old_codes, np.arange(len(months_years)))
+                 for name, cube in self.cubes.items()}
+        country_iso = new.groupby("Country", observed=True)["iso_alpha"].first().combine_first(self.country_iso)
+        return ChartData(df, months_years, cubes, country_iso, version, history=history)
@@ -0,0 +1,249 @@
+import json
+import os
+import sqlite3
+import threading
+from contextlib import closing
+
+import numpy as np
+import pandas as pd
+
+import metrics
+from aggregates import CUBES, Rollup, build_cubes
+
+# The row-level queries behind the callbacks, with two backends: PandasEngine over the table in memory and
+# SQLiteEngine over a database file written by ingest.py --database, which leaves the rows on disk. Both give
+# the streams per date of a country, month range and optional artist and track, and the monthly rollups the
+# cubes are built from; the filters and the grouping run in the backend. The country, artist and track filters
+# also take lists, and by splits the result into one series per value of those columns (comparisons).
+
+# The filters of series(), which are also the columns it can split by
+FILTERS = ["Country", "Artist", "Track Name"]
+
+
+def date_days(dates):
+    return pd.to_datetime(pd.Index(dates)).to_numpy("datetime64[D]").astype(np.int64)
+
+
+# Streams per date (one row per date with its day number and month_code), sorted by date. groups holds the
+# values and the codes of the by columns of every row, {column: (values, codes)}; the rows are then sorted by
+# those codes first.
+def date_series(dates, days, codes, month_codes, streams, groups=None):
+    groups = groups or {}
+    order = np.lexsort([days[codes]] + [group_codes for _, group_codes in reversed(list(groups.values()))])
+    series = pd.DataFrame({column: values[group_codes[order]] for column, (values, group_codes) in groups.items()})
+    return series.assign(Date=dates[codes[order]], day=days[codes[order]], month_code=month_codes[order],
+                         Streams=streams[order])
+
+
+class PandasEngine:
+    def __init__(self, df):
+        self.df = df
+        self.dates = np.asarray(df["Date"].cat.categories, dtype=object)
+        self.days = date_days(self.dates)
+
+    def __len__(self):
+        return len(self.df)
+
+    def categories(self, column):
+        return self.df[column].cat.categories.tolist()
+
+    def country_iso(self):
+        return self.df.groupby("Country", observed=True)["iso_alpha"].first()
+
+    def cubes(self, n_months, workers=1):
+        return build_cubes(self.df, n_months, workers)
+
+    def series(self, country, start, end, artist=None, track=None, by=()):
+        df = self.df
+        # Each filter narrows the rows left by the previous one, looking their codes up in a table of the wanted
+        # categories (with a last, unwanted slot for the code -1 of missing values)
+        rows = np.arange(len(df))
+        for column, value in zip(FILTERS, [country, artist, track]):
+            if value is not None or column == "Country":
+                categories = df[column].cat.categories
+                found = categories.get_indexer(value if isinstance(value, list) else [value])
+                wanted = np.zeros(len(categories) + 1, dtype=bool)
+                wanted[found[found >= 0]] = True
+                rows = rows[wanted[df[column].cat.codes.to_numpy()[rows]]]
+        month_codes = df["month_code"].to_numpy()
+        rows = rows[(month_codes[rows] >= start) & (month_codes[rows] <= end)]
+        metrics.rows(len(df), len(rows))
+        # One pass over the slice whatever the number of series: the rows are sorted on a single key made of the
+        # by and Date codes, and every run of equal keys is summed
+        sizes = [len(df[column].cat.categories) for column in by] + [len(self.dates)]
+        key = np.ravel_multi_index([df[column].cat.codes.to_numpy()[rows] for column in list(by) + ["Date"]],
+                                   sizes)
+        order = np.argsort(key, kind="stable")
+        key, rows = key[order], rows[order]
+        starts = np.flatnonzero(np.diff(key, prepend=-1))
+        streams = df["Streams"].to_numpy()[rows]
+        codes = np.unravel_index(key[starts], sizes)
+        groups = {column: (df[column].cat.categories.to_numpy(), codes[i]) for i, column in enumerate(by)}
+        return date_series(self.dates, self.days, codes[-1], month_codes[rows[starts]],
+                           np.add.reduceat(streams, starts) if len(starts) else streams, groups)
+
+
+# Database columns of the string columns of the chart table, which are stored as codes into the categories table
+SQL_COLUMNS = {"Country": "country", "Artist": "artist", "Track Name": "track", "Date": "date", "iso_alpha": "iso"}
+
+
+# Writes the encoded table to an SQLite database, with indexes covering the filters of series(), and the monthly
+# rollups of the cubes (see SQLCube), next to its final name and renamed last like the snapshot
+def write_database(df, months_years, path, source=None):
+    if os.path.exists(path + ".tmp"):
+        os.remove(path + ".tmp")
+    with closing(sqlite3.connect(path + ".tmp")) as db:
+        db.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)")
+        db.execute("CREATE TABLE categories (name TEXT, code INTEGER, value TEXT, PRIMARY KEY (name, code))")
+        db.execute("CREATE TABLE chart (country INTEGER, artist INTEGER, track INTEGER, date INTEGER, iso INTEGER, "
+                   "month_code INTEGER, streams INTEGER)")
+        meta = {"rows": len(df), "months": list(months_years),
+                "source": os.path.basename(source) if source else None}
+        db.executemany("INSERT INTO meta VALUES (?, ?)", [(k, json.dumps(v)) for k, v in meta.items()])
+        for column in SQL_COLUMNS:
+            db.executemany("INSERT INTO categories VALUES (?, ?, ?)",
+                           [(column, code, value) for code, value in enumerate(df[column].cat.categories)])
+        columns = [df[column].cat.codes.to_numpy() for column in SQL_COLUMNS]
+        columns += [df["month_code"].to_numpy(), df["Streams"].to_numpy()]
+        iso = list(SQL_COLUMNS).index("iso_alpha")
+        for start in range(0, len(df), 100000):
+            chunk = [column[start:start + 100000].tolist() for column in columns]
+            # Rows without an ISO-3 code have the categorical code -1
+            chunk[iso] = [None if code < 0 else code for code in chunk[iso]]
+            db.executemany("INSERT INTO chart VALUES (?, ?, ?, ?, ?, ?, ?)", zip(*chunk))
+        db.execute("CREATE INDEX chart_country ON chart (country, month_code, date, streams)")
+        db.execute("CREATE INDEX chart_track ON chart (country, artist, track, month_code, date, streams)")
+        for name, (columns, orders) in CUBES.items():
+            keys = ", ".join(SQL_COLUMNS[column] for column in columns)
+            db.execute("CREATE TABLE cube_{0} ({1}, month_code INTEGER, streams INTEGER, "
+                       "PRIMARY KEY ({2}, month_code)) WITHOUT ROWID"
+                       .format(name, ", ".join(SQL_COLUMNS[column] + " INTEGER" for column in columns), keys))
+            db.execute("INSERT INTO cube_{0} SELECT {1}, month_code, SUM(streams) FROM chart GROUP BY {1}, month_code"
+                       .format(name, keys))
+            for columns in orders:
+                keys = [SQL_COLUMNS[column] for column in columns]
+                keys += [SQL_COLUMNS[column] for column in CUBES[name][0] if SQL_COLUMNS[column] not in keys]
+                db.execute("CREATE INDEX cube_{0}_{1} ON cube_{0} ({2}, month_code, streams)"
+                           .format(name, keys[0], ", ".join(keys)))
+        db.commit()
+    os.replace(path + ".tmp", path)
+
+
+class SQLiteEngine:
+    def __init__(self, path):
+        self.path = path
+        # sqlite3 connections stay in the thread (and process) that opened them
+        self.local = threading.local()
+        with closing(self.connect()) as db:
+            meta = {k: json.loads(v) for k, v in db.execute("SELECT key, value FROM meta")}
+            self.values = {column: [] for column in SQL_COLUMNS}
+            for name, value in db.execute("SELECT name, value FROM categories ORDER BY name, code"):
+                self.values[name].append(value)
+        self.rows = meta["rows"]
+        self.months_years = meta["months"]
+        self.source = meta["source"]
+        self.codes = {column: {v: code for code, v in enumerate(values)} for column, values in self.values.items()}
+        self.dates = np.asarray(self.values["Date"], dtype=object)
+        self.days = date_days(self.dates)
+
+    def __len__(self):
+        return self.rows
+
+    def connect(self):
+        return sqlite3.connect("file:{}?mode=ro".format(self.path), uri=True)
+
+    def connection(self):
+        if getattr(self.local, "pid", None) != os.getpid():
+            self.local.db = self.connect()
+            self.local.pid = os.getpid()
+        return self.local.db
+
+    def categories(self, column):
+        return list(self.values[column])
+
+    def country_iso(self):
+        rows = self.connection().execute("SELECT country, MIN(iso) FROM chart GROUP BY country").fetchall()
+        return pd.Series([self.values["iso_alpha"][iso] if iso is not None else np.nan for _, iso in rows],
+                         index=[self.values["Country"][country] for country, _ in rows], name="iso_alpha")
+
+    # The rollups stay in the database too: the cubes query its cube_ tables
+    def cubes(self, n_months, workers=1):
+        tables = {name for name, in self.connection().execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        missing = [name for name in CUBES if "cube_" + name not in tables]
+        if missing:
+            raise RuntimeError("{} has no rollup tables for {}; rebuild it with ingest.py --database"
+                               .format(self.path, ", ".join(missing)))
+        return {name: SQLCube(self, name, columns) for name, (columns, _) in CUBES.items()}
+
+    def series(self, country, start, end, artist=None, track=None, by=()):
+        keys = "".join(SQL_COLUMNS[column] + ", " for column in by)
+        sql = "SELECT {}date, MIN(month_code), SUM(streams), COUNT(*) FROM chart WHERE month_code BETWEEN ? AND ?"
+        params = [start, end]
+        for column, value in zip(FILTERS, [country, artist, track]):
+            if isinstance(value, list):
+                sql += " AND {} IN ({})".format(SQL_COLUMNS[column], ", ".join("?" * len(value)))
+                params += [self.codes[column].get(v, -1) for v in value]
+            elif value is not None or column == "Country":
+                sql += " AND {} = ?".format(SQL_COLUMNS[column])
+                params.append(self.codes[column].get(value, -1))
+        rows = self.connection().execute(sql.format(keys) + " GROUP BY " + keys + "date", params).fetchall()
+        rows = np.array(rows, dtype=np.int64).reshape(-1, len(by) + 4)
+        # SQLite does not report the rows the query read, only the matching rows counted here
+        metrics.rows(None, int(rows[:, -1].sum()))
+        groups = {column: (np.asarray(self.values[column], dtype=object), rows[:, i]) for i, column in enumerate(by)}
+        return date_series(self.dates, self.days, rows[:, -4], rows[:, -3], rows[:, -2], groups)
+
+
+# The monthly rollups of a cube in the cube_ table of the database, one row per key and month with chart rows,
+# whose primary key is the key columns and the month. The callbacks' sums over a slider range are a GROUP BY over
+# the rows of the primary key (or of the index of an other order of the cube, e.g. artist first) below the
+# selected values, so only the keys with chart rows in the range come back and no process holds the cells.
+class SQLCube(Rollup):
+    def __init__(self, engine, name, names):
+        self.engine = engine
+        self.table = "cube_" + name
+        self.names = list(names)
+        self.values = [np.asarray(engine.values[column], dtype=object) for column in self.names]
+        self.dtypes = [pd.CategoricalDtype(engine.values[column]) for column in self.names]
+        # Name indexes of the key columns, built on the first search
+        self.indexes = {}
+
+    def code(self, level, value):
+        return self.engine.codes[self.names[level]].get(value)
+
+    # Codes of the key columns up to level and streams of the keys whose key columns have the values of where,
+    # {column: value or list of values}, with chart rows in [start, end], in key order
+    def query(self, start, end, where, level):
+        keys = ", ".join(SQL_COLUMNS[column] for column in self.names[:level + 1])
+        sql = "SELECT {0}, SUM(streams) FROM {1} WHERE month_code BETWEEN ? AND ?".format(keys, self.table)
+        params = [start, end]
+        for column, value in where.items():
+            value = value if isinstance(value, list) else [value]
+            sql += " AND {} IN ({})".format(SQL_COLUMNS[column], ", ".join("?" * len(value)))
+            params += [self.engine.codes[column].get(v, -1) for v in value]
+        rows = self.engine.connection().execute(sql + " GROUP BY {0} ORDER BY {0}".format(keys), params).fetchall()
+        rows = np.array(rows, dtype=np.int64).reshape(-1, level + 2)
+        metrics.rows(None, len(rows))
+        return list(rows[:, :-1].T), rows[:, -1]
+
+    def present(self, start, end, values):
+        return self.query(start, end, dict(zip(self.names, values)), len(values))
+
+    # Slider codes of the months with chart rows below *values
+    def months(self, *values):
+        sql = "SELECT DISTINCT month_code FROM {} WHERE 1".format(self.table)
+        for column in self.names[:len(values)]:
+            sql += " AND {} = ?".format(SQL_COLUMNS[column])
+        rows = self.engine.connection().execute(sql + " ORDER BY month_code",
+                                                [self.engine.codes[column].get(value, -1)
+                                                 for column, value in zip(self.names, values)]).fetchall()
+        return np.array([month for month, in rows], dtype=np.int64)
+
+    # Keys with at least one chart row in [start, end], together with their summed streams: all of them, or those
+    # with the values of where
+    def totals(self, start, end, where=None):
+        codes, streams = self.query(start, end, where or {}, len(self.names) - 1)
+        out = pd.DataFrame({name: pd.Categorical.from_codes(codes, dtype=dtype)
+                            for name, codes, dtype in zip(self.names, codes, self.dtypes)})
+        out["Streams"] = streams
+        return out
@@ -0,0 +1,196 @@
+import base64
+import json
+
+import numpy as np
+import pandas as pd
+import plotly.io as pio
+from dash import Patch
+from plotly.io.json import to_json_plotly
+
+# Figures are built as plain dicts around prebuilt JSON templates: the static part of each trace and layout
+# (colorscale, geo settings, axes, Plotly's default template, ...) is encoded once at import, and a request
+# only encodes its data arrays and title. Numeric arrays go out as Plotly typed arrays (base64 of the raw
+# buffer), which skips converting them to Python lists, and nothing goes through Plotly's validation.
+
+INT32 = np.iinfo(np.int32)
+
+
+# A JSON object made of a prebuilt template plus the keys of one request
+class Template:
+    def __init__(self, static):
+        self.fragment = json.dumps(static, separators=(",", ":"))[1:-1]
+
+    def fill(self, **values):
+        return Filled(self, values)
+
+
+class Filled:
+    def __init__(self, template, values):
+        self.template = template
+        self.values = values
+
+
+def encode_array(array):
+    if array.dtype.kind in "iu":
+        if array.size and (array.min() < INT32.min or array.max() > INT32.max):
+            array = array.astype("<f8")
+        else:
+            array = array.astype("<i4")
+    elif array.dtype.kind == "f":
+        array = array.astype("<f8")
+    else:
+        return json.dumps(array.tolist(), separators=(",", ":"))
+    dtype = "f8" if array.dtype.kind == "f" else "i4"
+    return '{"dtype":"%s","bdata":"%s"}' % (dtype, base64.b64encode(array.tobytes()).decode())
+
+
+def dumps(value):
+    if isinstance(value, Patch):
+        value = value.to_plotly_json()
+    if isinstance(value, Filled):
+        parts = [value.template.fragment] if value.template.fragment else []
+        parts += [json.dumps(k) + ":" + dumps(v) for k, v in value.values.items()]
+        return "{" + ",".join(parts) + "}"
+    if isinstance(value, dict):
+        return "{" + ",".join(json.dumps(str(k)) + ":" + dumps(v) for k, v in value.items()) + "}"
+    if isinstance(value, (list, tuple)):
+        return "[" + ",".join(dumps(v) for v in value) + "]"
+    if isinstance(value, (pd.Series, pd.Index)):
+        value = np.asarray(value) if value.dtype.kind in "iuf" else np.asarray(value, dtype=object)
+    if isinstance(value, np.ndarray):
+        return encode_array(value)
+    if isinstance(value, np.generic):
+        return json.dumps(value.item())
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return json.dumps(value)
+    return to_json_plotly(value)
+
+
+# Colors of the compared series, Spotify green first
+COMPARE_COLORS = ["#1ED760", "rgb(89, 89, 89)", "#2D46B9", "#F573A0", "#FFC864", "#509BF5", "#AF2896", "#E8115B",
+                  "#148A08", "#B49BC8"]
+
+LAYOUT_TEMPLATE = json.loads(to_json_plotly(pio.templates[pio.templates.default]))
+
+CHOROPLETH_TRACE = Template({
+    "type": "choropleth",
+    "autocolorscale": False,
+    "colorscale": [[0.0, "rgb(211, 248, 224)"],
+                   [0.1111111111111111, "rgb(167, 241, 193)"],
+                   [0.2222222222222222, "rgb(123, 234, 162)"],
+                   [0.3333333333333333, "rgb(79, 227, 131)"],
+                   [0.4444444444444444, "rgb(34, 221, 100)"],
+                   [0.5555555555555556, "rgb(29, 185, 84)"],  # Spotify color
+                   [0.6666666666666666, "rgb(24, 154, 70)"],
+                   [0.7777777777777778, "rgb(17, 110, 50)"],
+                   [0.8888888888888888, "rgb(10, 66, 30)"],
+                   [1.0, "rgb(7, 44, 20)"]],
+    "marker": {"line": {"color": "white", "width": 0.7}},
+    "colorbar": {"thickness": 36, "len": 0.8, "outlinewidth": 0,
+                 "title": {"text": "Number of <br> streams", "side": "bottom"}},
+})
+
+CHOROPLETH_LAYOUT = Template({
+    "height": 450,
+    "margin": {"l": 0, "b": 0, "t": 80, "r": 100},
+    "geo": {"showframe": False, "showcoastlines": False, "projection": {"type": "equirectangular"}},
+})
+
+LINE_TRACE = Template({
+    "type": "scatter",
+    "mode": "lines",
+    "line": {"color": "#1ED760", "width": 2},
+})
+
+# Compared series get their colors from COMPARE_COLORS
+COMPARED_LINE_TRACE = Template({
+    "type": "scatter",
+    "mode": "lines",
+})
+
+LINE_LAYOUT = Template({
+    "xaxis": {"title": {"text": "Date"}, "gridcolor": "LightGrey", "showline": True, "linewidth": 1.1,
+              "linecolor": "rgb(89, 89, 89)", "tickfont": {"family": "Arial", "size": 12}},
+    "yaxis": {"title": {"text": "Streams"}, "gridcolor": "LightGrey", "tickfont": {"family": "Arial", "size": 12}},
+    "legend": {"x": 1, "y": 1},
+    "paper_bgcolor": "rgb(0,0,0,0)",
+    "plot_bgcolor": "rgb(0,0,0,0)",
+    "height": 450,
+    "template": LAYOUT_TEMPLATE,
+})
+
+BAR_TRACE = Template({
+    "type": "bar",
+    "orientation": "h",
+    "width": .05,
+})
+
+GROUPED_BAR_TRACE = Template({
+    "type": "bar",
+    "orientation": "h",
+})
+
+BAR_LAYOUT = Template({
+    "xaxis": {"title": {"text": "Number of streams"}, "gridcolor": "LightGrey", "showline": True,
+              "linecolor": "rgb(89, 89, 89)", "tickfont": {"family": "Arial", "size": 12}},
+    "yaxis": {"gridcolor": "LightGrey", "tickfont": {"family": "Arial", "size": 10}, "autorange": "reversed"},
+    "paper_bgcolor": "rgb(0,0,0,0)",
+    "plot_bgcolor": "rgb(0,0,0,0)",
+    "template": LAYOUT_TEMPLATE,
+})
+
+
+def choropleth(locations, z, text, title):
+    return {"data": [CHOROPLETH_TRACE.fill(locations=locations, z=z, text=text)],
+            "layout": CHOROPLETH_LAYOUT.fill(title={"text": title, "font": {"size": 14}})}
+
+
+def line(x, y, title, top):
+    return {"data": [LINE_TRACE.fill(x=x, y=y)],
+            "layout": LINE_LAYOUT.fill(title={"text": title, "x": .5, "y": .95, "font": {"size": 14}},
+                                       margin={"l": 40, "b": 40, "t": top, "r": 40})}
+
+
+# One line per compared series, given as (name, x, y)
+def lines(series, title, top):
+    return {"data": [COMPARED_LINE_TRACE.fill(x=x, y=y, name=name,
+                                              line={"color": COMPARE_COLORS[i % len(COMPARE_COLORS)], "width": 2})
+                     for i, (name, x, y) in enumerate(series)],
+            "layout": LINE_LAYOUT.fill(title={"text": title, "x": .5, "y": .95, "font": {"size": 14}},
+                                       margin={"l": 40, "b": 40, "t": top, "r": 40})}
+
+
+def bar(x, y, color, title, left):
+    return {"data": [BAR_TRACE.fill(x=x, y=y, marker={"color": color, "line": {"color": color, "width": 10}})],
+            "layout": BAR_LAYOUT.fill(title={"text": title, "x": .5, "font": {"size": 14}},
+                                      margin={"l": left, "b": 40, "t": 50, "r": 100})}
+
+
+# Grouped bars: one bar per compared series, given as (name, x), next to each other on every y
+def bars(series, y, title, left):
+    width = .8 / len(series)
+    return {"data": [GROUPED_BAR_TRACE.fill(x=x, y=y, name=name, width=width, offset=-.4 + i * width,
+                                            marker={"color": COMPARE_COLORS[i % len(COMPARE_COLORS)]})
+                     for i, (name, x) in enumerate(series)],
+            "layout": BAR_LAYOUT.fill(title={"text": title, "x": .5, "font": {"size": 14}},
+                                      margin={"l": left, "b": 40, "t": 50, "r": 100})}
+
+
+# Partial update of a graph that shows a figure of the same templates (the layout starts every graph with an empty
+# one): only the keys filled in for this request are sent, the template parts stay in the browser. The traces
+# are sent whole when their number can change (comparisons), since the graph may show more of them.
+def patch(figure, traces=False):
+    update = Patch()
+    if traces:
+        update["data"] = figure["data"]
+    else:
+        for key, value in figure["data"][0].values.items():
+            update["data"][0][key] = value
+    for key, value in figure["layout"].values.items():
+        update["layout"][key] = value
+    return update
+
+
+EMPTY_CHOROPLETH = json.loads(dumps(choropleth([], [], [], None)))
+EMPTY_LINE = json.loads(dumps(line([], [], None, 60)))
+EMPTY_BAR = json.loads(dumps(bar([], [], "rgb(29, 185, 84)", None, 120)))
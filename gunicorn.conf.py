@@ -0,0 +1,36 @@
+import gc
+import os
+
+# Production serving profile: the app and its data are loaded once in the master and shared copy-on-write by
+# the forked workers, each of which answers several requests at once from a thread pool, so a slow callback
+# does not hold up the other requests of its worker.
+#   gunicorn --config gunicorn.conf.py app:server
+
+bind = "0.0.0.0:" + os.environ.get("PORT", "8000")
+preload_app = True
+workers = int(os.environ.get("WEB_CONCURRENCY", 2))
+worker_class = "gthread"
+threads = int(os.environ.get("CHART_THREADS", 8))
+timeout = 120
+
+# app.py leaves its background threads to post_fork
+os.environ["CHART_PRELOAD"] = "1"
+
+
+# Runs in the master after the app was loaded and before the first fork. With CHART_LAZY every worker loads the
+# data after the fork, so there is nothing to test yet.
+def when_ready(server):
+    import app
+    import metrics
+    import selftest
+    if os.environ.get("CHART_SELFTEST", "1") != "0" and not app.lazy:
+        server.log.info(selftest.run(app, threads))
+    server.log.info(metrics.startup_report())
+    # Objects allocated so far are never collected, so the collector does not write to (and copy) the shared
+    # pages of the workers
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    import app
+    app.start_threads()
@@ -0,0 +1,35 @@
+import argparse
+import time
+
+from aggregates import build_cubes
+from data import missing_country_codes, parse, write_snapshot
+from engine import write_database
+
+# Cleans the Spotify Charts CSV once and writes the columnar snapshot the app memory-maps at startup, rollups
+# included, and with --database the SQLite database the app queries instead when CHART_DATABASE points to it:
+#   python ingest.py [data/spotify_month.csv] [data/snapshot] [--database data/chart.db]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the memory-mapped snapshot of the chart data")
+    parser.add_argument("csv", nargs="?", default="data/spotify_month.csv")
+    parser.add_argument("snapshot", nargs="?", default="data/snapshot")
+    parser.add_argument("--database", help="also write the SQLite database to this path")
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    df, months_years, history = parse(args.csv)
+    write_snapshot(df, months_years, args.snapshot, args.csv, build_cubes(df, len(months_years)), history)
+    print("Wrote {} rows over {} months to {} in {:.2f}s".format(len(df), len(months_years), args.snapshot,
+                                                                 time.perf_counter() - started))
+    if args.database:
+        started = time.perf_counter()
+        write_database(df, months_years, args.database, args.csv)
+        print("Wrote {} in {:.2f}s".format(args.database, time.perf_counter() - started))
+    missing = missing_country_codes(df)
+    if missing:
+        print("No ISO-3 code for: " + ", ".join(missing))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,224 @@
+import contextlib
+import functools
+import logging
+import sys
+import threading
+import time
+import traceback
+from collections import Counter, defaultdict
+
+from flask import Response
+
+from figures import dumps
+
+# Per-callback instrumentation: wall time, rows scanned and returned by the data layer, output payload bytes and
+# cache status, broken down by callback and input pattern, exposed in the Prometheus text format on /metrics.
+# The numbers are per process; with several gunicorn workers each scrape sees the worker that answered it.
+
+logger = logging.getLogger(__name__)
+
+BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5]
+
+lock = threading.Lock()
+calls = defaultdict(lambda: {"count": 0, "seconds": 0.0, "scanned": 0, "returned": 0, "bytes": 0})
+histograms = defaultdict(lambda: [0] * (len(BUCKETS) + 1))
+local = threading.local()
+# Seconds of each startup phase of the process (imports, data, rollups, ...), in the order they ended
+startup = []
+# Output caches by name, whose stats() are exported too
+caches = {}
+
+
+# Called by the data layer and the cache while an instrumented callback runs; no-ops outside of one. scanned is
+# None when the backend does not know how many rows it read (SQLite), which leaves the callback out of the rows
+# scanned.
+def rows(scanned, returned):
+    record = getattr(local, "record", None)
+    if record is not None:
+        if scanned is None or record["scanned"] is None:
+            record["scanned"] = None
+        else:
+            record["scanned"] += scanned
+        record["returned"] += returned
+
+
+def note(**values):
+    record = getattr(local, "record", None)
+    if record is not None:
+        record.update(values)
+
+
+def startup_phase(name, started):
+    startup.append((name, time.perf_counter() - started))
+
+
+@contextlib.contextmanager
+def phase(name):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        startup_phase(name, started)
+
+
+# One line for the log, e.g. "Startup 1.62s: imports 1.05s, data 0.31s, rollups 0.24s, layout 0.02s"
+def startup_report():
+    return "Startup {:.2f}s: ".format(sum(seconds for _, seconds in startup)) + ", ".join(
+        "{} {:.2f}s".format(name, seconds) for name, seconds in startup)
+
+
+# Low-cardinality description of the inputs, e.g. "Global,none,values,none,range"
+def pattern(args):
+    parts = []
+    for arg in args:
+        if arg is None or (isinstance(arg, (list, tuple)) and not arg):
+            parts.append("none")
+        elif isinstance(arg, (list, tuple)) and isinstance(arg[0], str):
+            # The selection of a multi-select dropdown
+            parts.append("value" if len(arg) == 1 else "values")
+        elif isinstance(arg, (list, tuple)):
+            parts.append("range")
+        elif arg == "Global":
+            parts.append("Global")
+        else:
+            parts.append("value")
+    return ",".join(parts)
+
+
+def instrument(func):
+    name = func.__name__
+
+    @functools.wraps(func)
+    def wrapper(*args):
+        local.record = {"scanned": 0, "returned": 0, "cache": "none", "bytes": None}
+        started = time.perf_counter()
+        profiler.begin(name, started)
+        try:
+            result = func(*args)
+        finally:
+            elapsed = time.perf_counter() - started
+            profiler.end(name, elapsed)
+            record, local.record = local.record, None
+        if record["bytes"] is None:
+            record["bytes"] = len(dumps(result))
+        with lock:
+            stats = calls[(name, pattern(args), record["cache"])]
+            stats["count"] += 1
+            stats["seconds"] += elapsed
+            if record["scanned"] is None or stats["scanned"] is None:
+                stats["scanned"] = None
+            else:
+                stats["scanned"] += record["scanned"]
+            stats["returned"] += record["returned"]
+            stats["bytes"] += record["bytes"]
+            histogram = histograms[name]
+            for i, bound in enumerate(BUCKETS):
+                if elapsed <= bound:
+                    histogram[i] += 1
+                    break
+            else:
+                histogram[-1] += 1
+        return result
+    return wrapper
+
+
+# Samples the stacks of callbacks that run longer than threshold seconds, from one background thread, and
+# hands the samples to hook (logging the hottest frames by default). Fast requests only pay a dict update.
+class SlowRequestProfiler:
+    def __init__(self):
+        self.threshold = None
+        self.interval = 0.005
+        self.hook = self.log
+        self.active = {}
+        self.samples = {}
+
+    def start(self, threshold, interval=0.005, hook=None):
+        self.threshold = threshold
+        self.interval = interval
+        if hook is not None:
+            self.hook = hook
+        threading.Thread(target=self.run, name="slow-request-profiler", daemon=True).start()
+
+    def begin(self, name, started):
+        if self.threshold is not None:
+            # Samples the sampler took after the previous callback of the thread ended belong to none
+            self.samples.pop(threading.get_ident(), None)
+            self.active[threading.get_ident()] = started
+
+    def end(self, name, elapsed):
+        if self.threshold is None:
+            return
+        thread = threading.get_ident()
+        self.active.pop(thread, None)
+        samples = self.samples.pop(thread, None)
+        if samples:
+            self.hook(name, elapsed, samples)
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            now = time.perf_counter()
+            frames = sys._current_frames()
+            for thread, started in list(self.active.items()):
+                if now - started > self.threshold and thread in frames:
+                    stack = tuple(traceback.format_stack(frames[thread])[-8:])
+                    # Unless the callback ended (and maybe the next one began) since the items were listed
+                    if self.active.get(thread) == started:
+                        self.samples.setdefault(thread, Counter())[stack] += 1
+
+    def log(self, name, elapsed, samples):
+        stack, count = samples.most_common(1)[0]
+        logger.warning("Slow callback %s took %.0f ms, %d of %d samples in:\n%s", name, elapsed * 1000, count,
+                       sum(samples.values()), "".join(stack))
+
+
+profiler = SlowRequestProfiler()
+
+
+def labels(**values):
+    return "{" + ",".join('{}="{}"'.format(k, str(v).replace('"', '\\"')) for k, v in values.items()) + "}"
+
+
+def render():
+    lines = []
+    with lock:
+        for metric, field, kind, text in [
+                ("dash_callback_requests_total", "count", "counter", "Callback calls"),
+                ("dash_callback_seconds_total", "seconds", "counter", "Wall time spent in callbacks"),
+                ("dash_callback_rows_scanned_total", "scanned", "counter",
+                 "Rows read by the data layer, not known with the SQLite database"),
+                ("dash_callback_rows_returned_total", "returned", "counter", "Rows selected by the data layer"),
+                ("dash_callback_payload_bytes_total", "bytes", "counter", "Serialized callback output")]:
+            lines += ["# HELP {} {}.".format(metric, text), "# TYPE {} {}".format(metric, kind)]
+            for (name, inputs, cache), stats in sorted(calls.items()):
+                if stats[field] is None:
+                    continue
+                lines.append(metric + labels(callback=name, pattern=inputs, cache=cache) + " " + str(stats[field]))
+        lines += ["# HELP dash_callback_duration_seconds Callback wall time.",
+                  "# TYPE dash_callback_duration_seconds histogram"]
+        for name, histogram in sorted(histograms.items()):
+            total = 0
+            for bound, count in zip(BUCKETS + ["+Inf"], histogram):
+                total += count
+                lines.append("dash_callback_duration_seconds_bucket" + labels(callback=name, le=bound) +
+                             " " + str(total))
+            seconds = sum(s["seconds"] for (n, _, _), s in calls.items() if n == name)
+            lines.append("dash_callback_duration_seconds_sum" + labels(callback=name) + " " + str(seconds))
+            lines.append("dash_callback_duration_seconds_count" + labels(callback=name) + " " + str(total))
+    lines += ["# HELP dash_startup_seconds Time spent in each startup phase.", "# TYPE dash_startup_seconds gauge"]
+    for name, seconds in list(startup):
+        lines.append("dash_startup_seconds" + labels(phase=name) + " " + str(seconds))
+    stats = {name: cache.stats() for name, cache in sorted(caches.items())}
+    for metric, field, kind, text in [
+            ("dash_cache_hits_total", "hits", "counter", "Output cache hits"),
+            ("dash_cache_misses_total", "misses", "counter", "Output cache misses"),
+            ("dash_cache_entries", "entries", "gauge", "Entries in the output cache"),
+            ("dash_cache_bytes", "bytes", "gauge", "Bytes of the entries in the output cache")]:
+        lines += ["# HELP {} {}.".format(metric, text), "# TYPE {} {}".format(metric, kind)]
+        for name, values in stats.items():
+            lines.append(metric + labels(cache=name) + " " + str(values[field]))
+    return "\n".join(lines) + "\n"
+
+
+def register(server):
+    server.add_url_rule("/metrics", "metrics", lambda: Response(render(), mimetype="text/plain; version=0.0.4"))
@@ -0,0 +1,155 @@
+import glob
+import gzip
+import hashlib
+import json
+import logging
+import os
+import sys
+
+import dash
+from flask import Response, request
+
+from data import snapshot_is_current
+
+logger = logging.getLogger(__name__)
+
+# Pre-rendered callback responses for the landing view of every country: its months with data, no comparison, no
+# artist and no song. The build step replays the requests a browser sends for those views, the figures as well as
+# the option lists, and stores the gzip-compressed responses; the server then answers the same requests from memory
+# without running a callback. The bundle records the settings and the code it was built with, and the server only
+# uses it when they match its own. Rebuild after changing the data or the figures.
+#   python prerender.py [data/prerendered]
+
+# The sources the responses depend on, hashed into the bundle together with the Dash version
+SOURCES = ["app.py", "aggregates.py", "data.py", "engine.py", "figures.py", "timeseries.py"]
+
+
+def code_version():
+    digest = hashlib.sha1(dash.__version__.encode())
+    for name in SOURCES:
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), name), "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+# What the responses depend on besides the data: the settings of the callbacks and the code
+def bundle_settings(options_limit, line_points):
+    return {"options_limit": options_limit, "line_points": line_points, "code": code_version()}
+
+
+# The /_dash-update-component bodies the browser posts for the filter values (the dropdowns not being searched),
+# for every server-side callback whose inputs and state are all among them
+def request_bodies(dependencies, values):
+    def value(item):
+        return None if item["property"] == "search_value" else values[item["id"]]
+
+    for dependency in dependencies:
+        if dependency.get("clientside_function"):
+            continue
+        if any(i["id"] not in values for i in dependency["inputs"] + dependency["state"]):
+            continue
+        output = dependency["output"]
+        if output.startswith(".."):
+            outputs = [dict(zip(("id", "property"), o.split("."))) for o in output.strip(".").split("...")]
+        else:
+            outputs = dict(zip(("id", "property"), output.split(".")))
+        body_inputs = [{"id": i["id"], "property": i["property"], "value": value(i)} for i in dependency["inputs"]]
+        body_state = [{"id": i["id"], "property": i["property"], "value": value(i)} for i in dependency["state"]]
+        yield {"output": output, "outputs": outputs, "inputs": body_inputs, "state": body_state,
+               "changedPropIds": [body_inputs[0]["id"] + "." + body_inputs[0]["property"]]}
+
+
+# Identifies a request by its outputs and the values of its inputs and state
+def request_key(body):
+    values = [[i.get("id"), i.get("property"), i.get("value")] for i in body.get("inputs", []) + body.get("state", [])]
+    return hashlib.sha1(json.dumps([body.get("output"), values], sort_keys=True).encode()).hexdigest()
+
+
+def landing_views(chart):
+    for country in chart.av_country:
+        months = chart.cubes["country"].months(country)
+        yield {"country": country, "compare": None, "date_slider": [int(months[0]), int(months[-1])], "artist": None,
+               "song": None, "choropleth_map": None}
+
+
+def build(app, csv_path, directory):
+    client = app.server.test_client()
+    dependencies = client.get("/_dash-dependencies").get_json()
+    os.makedirs(directory, exist_ok=True)
+    written = set()
+    for values in landing_views(app.store.current):
+        for body in request_bodies(dependencies, values):
+            key = request_key(body)
+            if key in written:
+                continue
+            response = client.post("/_dash-update-component", json=body)
+            if response.status_code != 200:
+                continue
+            path = os.path.join(directory, key + ".json.gz")
+            with open(path + ".tmp", "wb") as f:
+                f.write(gzip.compress(response.data, 9))
+            os.replace(path + ".tmp", path)
+            written.add(key)
+    for path in glob.glob(os.path.join(directory, "*.json.gz")):
+        if os.path.basename(path)[:-len(".json.gz")] not in written:
+            os.remove(path)
+    # Written last: the responses count as current when meta.json is at least as recent as the CSV
+    with open(os.path.join(directory, "meta.json.tmp"), "w") as f:
+        json.dump({"source": os.path.basename(csv_path), "version": app.store.current.version,
+                   "settings": bundle_settings(app.options_limit, app.line_points), "responses": len(written)}, f)
+    os.replace(os.path.join(directory, "meta.json.tmp"), os.path.join(directory, "meta.json"))
+    return len(written)
+
+
+class Bundle:
+    def __init__(self, directory, meta):
+        self.version = meta["version"]
+        self.responses = {}
+        for path in glob.glob(os.path.join(directory, "*.json.gz")):
+            with open(path, "rb") as f:
+                self.responses[os.path.basename(path)[:-len(".json.gz")]] = f.read()
+
+    # Answers the pre-rendered requests before Dash dispatches them, as long as no months were appended since
+    def register(self, server, store):
+        @server.before_request
+        def answer():
+            if not request.path.endswith("/_dash-update-component") or store.current.version != self.version:
+                return None
+            body = request.get_json(silent=True)
+            key = request_key(body) if isinstance(body, dict) else None
+            data = self.responses.get(key)
+            if data is None:
+                return None
+            if "gzip" in request.accept_encodings:
+                response = Response(data, mimetype="application/json", headers={"Content-Encoding": "gzip"})
+            else:
+                response = Response(gzip.decompress(data), mimetype="application/json")
+            response.vary.add("Accept-Encoding")
+            return response
+
+
+# The pre-rendered responses in directory when they were built from csv_path, are at least as recent and were built
+# with the same settings and code
+def load_bundle(csv_path, directory, options_limit, line_points):
+    if not snapshot_is_current(csv_path, directory):
+        return None
+    with open(os.path.join(directory, "meta.json")) as f:
+        meta = json.load(f)
+    if meta.get("settings") != bundle_settings(options_limit, line_points):
+        logger.warning("The pre-rendered responses in %s were built with other settings or code, rerun prerender.py",
+                       directory)
+        return None
+    return Bundle(directory, meta)
+
+
+def main():
+    directory = sys.argv[1] if len(sys.argv) > 1 else "data/prerendered"
+    # Build from the callbacks themselves, not from an older bundle
+    os.environ["CHART_PRERENDERED_DIR"] = ""
+    import app
+    csv_path = os.environ.get("CHART_CSV", "data/spotify_month.csv")
+    print("Wrote {} responses to {}".format(build(app, csv_path, directory), directory))
+
+
+if __name__ == "__main__":
+    main()
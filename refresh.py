@@ -0,0 +1,105 @@
+import glob
+import hashlib
+import logging
+import os
+import threading
+import time
+
+from data import read_chart_rows
+
+logger = logging.getLogger(__name__)
+
+
+def modified(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+# Holds the ChartData the callbacks read. A callback takes store.current once and works on that snapshot;
+# a refresh builds the next ChartData aside and replaces the reference in a single assignment, so running
+# callbacks are never affected and no request is dropped.
+class ChartStore:
+    def __init__(self, chart=None):
+        self.chart = chart
+        self.error = None
+        self.ready = threading.Event()
+        if chart is not None:
+            self.ready.set()
+        self.ingested = set()
+        # Files that could not be appended, with their modification time: skipped until they change
+        self.failed = {}
+        # Version of the first ChartData, which the versions of the appended ones build on
+        self.base_version = None
+        self.lock = threading.Lock()
+
+    # Waits while the first ChartData is still being loaded by load()
+    @property
+    def current(self):
+        chart = self.chart
+        if chart is None:
+            self.ready.wait()
+            if self.error is not None:
+                raise RuntimeError("The chart data could not be loaded") from self.error
+            chart = self.chart
+        return chart
+
+    # Loads the first ChartData from load_chart() in the background, so the server accepts requests meanwhile
+    def load(self, load_chart):
+        def run():
+            started = time.perf_counter()
+            try:
+                self.chart = load_chart()
+                logger.info("Loaded the chart data in %.2fs", time.perf_counter() - started)
+            except Exception as e:
+                self.error = e
+                logger.exception("Could not load the chart data")
+            self.ready.set()
+
+        thread = threading.Thread(target=run, name="chart-load", daemon=True)
+        thread.start()
+        return thread
+
+    # Appends the files of paths not appended yet, one at a time, so a file that cannot be read or appended is
+    # logged and skipped without holding back the others
+    def append_files(self, paths):
+        with self.lock:
+            appended = []
+            for path in sorted(paths):
+                name = os.path.basename(path)
+                if name in self.ingested or self.failed.get(name) == modified(path):
+                    continue
+                ingested = self.ingested | {name}
+                if self.base_version is None:
+                    self.base_version = self.current.version
+                # Named after the first data and the files appended to it, so workers that ingested the same files
+                # share cache entries
+                version = hashlib.sha1("\n".join([self.base_version] + sorted(ingested)).encode()).hexdigest()[:12]
+                try:
+                    chart = self.current.append(read_chart_rows(path), version)
+                except Exception:
+                    logger.exception("Could not append %s, it is skipped until it changes", path)
+                    self.failed[name] = modified(path)
+                    continue
+                self.failed.pop(name, None)
+                self.chart, self.ingested = chart, ingested
+                appended.append(path)
+            if appended:
+                logger.info("Appended %s, %d months of data", ", ".join(appended), len(self.current.months_years))
+            return bool(appended)
+
+    # Polls directory for new monthly chart files (same columns as spotify_month.csv). Files should be
+    # written elsewhere and moved in, so a file is never read half written.
+    def watch(self, directory, interval=60):
+        def poll():
+            while True:
+                try:
+                    self.append_files(glob.glob(os.path.join(directory, "*.csv")))
+                except Exception:
+                    logger.exception("Could not append the chart files of %s", directory)
+                time.sleep(interval)
+
+        thread = threading.Thread(target=poll, name="chart-refresh", daemon=True)
+        thread.start()
+        return thread
@@ -0,0 +1,55 @@
+import inspect
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from figures import dumps
+
+# Startup self-test of the server-side callbacks: computes a set of typical views one at a time, then all of them
+# again from many threads at once over the same shared data, and fails when a call raises or a result differs.
+# The callbacks are called without the output cache, so every call does the full work.
+#   python selftest.py
+
+
+# Country, compared countries, months, artists and songs of each view: no artist, the top artist, its top song,
+# and comparisons of two countries and of the top two artists and their songs
+def views(chart):
+    first, last = chart.full_range
+    middle = (first + last) // 2
+    countries = ["Global"] + [c for c in chart.av_country if c != "Global"][:3]
+    for country, other in zip(countries, countries[1:] + countries[:1]):
+        for date in ([first, last], [middle, last]):
+            artists = chart.cubes["country_artist"].search(date[0], date[1], (country,), None, 2)
+            songs = chart.cubes["country_track"].search(date[0], date[1], (country, artists[:1]), None, 1)
+            for compare, a, s in [(None, [], []), (None, artists[:1], []), (None, artists[:1], songs[:1]),
+                                  ([other], [], []), (None, artists, []), ([other], artists, songs[:1])]:
+                yield country, compare, date, a, s
+
+
+def calls(app, chart):
+    callbacks = {name: inspect.unwrap(getattr(app, name)) for name in
+                 ["set_artist_options", "set_song_options", "set_song_value", "update_charts",
+                  "update_choropleth_map"]}
+    for c, o, d, a, s in views(chart):
+        yield "set_artist_options", lambda c=c, d=d, a=a: callbacks["set_artist_options"](c, d, None, a)
+        yield "set_song_options", lambda c=c, d=d, a=a, s=s: callbacks["set_song_options"](c, d, a, None, s)
+        yield "set_song_value", lambda c=c, d=d, a=a: callbacks["set_song_value"](c, d, a)
+        yield "update_charts", lambda c=c, o=o, d=d, a=a, s=s: callbacks["update_charts"](c, o, a, s, d)
+        yield "update_choropleth_map", lambda d=d, a=a, s=s: callbacks["update_choropleth_map"](a, s, d)
+
+
+def run(app, threads=8, rounds=4):
+    started = time.perf_counter()
+    todo = list(calls(app, app.store.current))
+    serial = [dumps(call()) for _, call in todo]
+    with ThreadPoolExecutor(threads) as pool:
+        concurrent = list(pool.map(lambda i: dumps(todo[i % len(todo)][1]()), range(len(todo) * rounds)))
+    differ = sorted({todo[i % len(todo)][0] for i, value in enumerate(concurrent) if value != serial[i % len(todo)]})
+    if differ:
+        raise RuntimeError("Callbacks gave different results when run concurrently: " + ", ".join(differ))
+    return "Self-test passed: {} callback calls, {} threads, {:.2f}s".format(len(serial) + len(concurrent), threads,
+                                                                           time.perf_counter() - started)
+
+
+if __name__ == "__main__":
+    import app
+    print(run(app))
@@ -0,0 +1,77 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from benchmarks.generate import generate
+from data import ChartData, parse, read_chart_rows
+from refresh import ChartStore
+
+# Appending chart files must give the chart that parsing all of them together gives:
+#   python -m pytest tests
+
+
+@pytest.fixture(scope="module")
+def files(tmp_path_factory):
+    directory = tmp_path_factory.mktemp("charts")
+    rows = directory / "all.csv"
+    generate(str(rows), countries=4, months=8, artists=300, tracks=10, chart_size=40)
+    df = pd.read_csv(rows)
+    paths = {}
+    for name, months in [("first", slice(0, 4)), ("second", slice(4, 6)), ("third", slice(6, 8))]:
+        paths[name] = str(directory / (name + ".csv"))
+        df[df["month_year"].isin(sorted(df["month_year"].unique())[months])].to_csv(paths[name], index=False)
+    paths["all"] = str(rows)
+    return paths
+
+
+def combined(*paths):
+    return pd.concat([pd.read_csv(path) for path in paths])
+
+
+def rows(chart):
+    df = chart.df.assign(month_year=np.asarray(chart.months_years)[chart.df["month_code"].to_numpy()])
+    df = df[["Country", "Artist", "Track Name", "month_year", "Streams"]].astype(object)
+    return df.sort_values(list(df.columns)).reset_index(drop=True)
+
+
+def assert_same(appended, parsed):
+    assert appended.months_years == parsed.months_years
+    pd.testing.assert_frame_equal(rows(appended), rows(parsed))
+    for name, cube in parsed.cubes.items():
+        np.testing.assert_array_equal(appended.cubes[name].totals(0, len(parsed.months_years) - 1),
+                                      cube.totals(0, len(parsed.months_years) - 1))
+    np.testing.assert_array_equal(appended.history[0], parsed.history[0])
+    assert len(appended.history[1]) == len(parsed.history[1])
+
+
+def chart(path):
+    df, months_years, history = parse(path)
+    return ChartData(df, months_years, history=history)
+
+
+def test_append_matches_parse(files, tmp_path):
+    both = tmp_path / "both.csv"
+    combined(files["first"], files["second"]).to_csv(both, index=False)
+    appended = chart(files["first"]).append(read_chart_rows(files["second"]), "2")
+    assert_same(appended, chart(str(both)))
+
+
+def test_append_twice_matches_parse(files):
+    appended = chart(files["first"]).append(read_chart_rows(files["second"]), "2")
+    appended = appended.append(read_chart_rows(files["third"]), "3")
+    assert_same(appended, chart(files["all"]))
+
+
+def test_append_files_skips_broken_file(files, tmp_path):
+    broken = tmp_path / "broken.csv"
+    pd.read_csv(files["third"]).drop(columns="Country").to_csv(broken, index=False)
+    store = ChartStore(chart(files["first"]))
+    assert store.append_files([str(broken), files["second"], files["third"]])
+    assert_same(store.current, chart(files["all"]))
+    assert store.ingested == {"second.csv", "third.csv"}
+    assert not store.append_files([str(broken)])
+
+
+def test_append_same_file_again(files):
+    appended = chart(files["first"]).append(read_chart_rows(files["second"]), "2")
+    assert appended.append(read_chart_rows(files["second"]), "3") is appended
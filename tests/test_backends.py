@@ -0,0 +1,138 @@
+import importlib
+import inspect
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from aggregates import build_cubes
+from benchmarks.generate import generate
+from data import ChartData, parse, write_snapshot
+from engine import SQLiteEngine, write_database
+from figures import dumps
+
+# The callbacks must give the same outputs whichever way the chart data was loaded: parsed from the CSV, with the
+# rollups built in one process or in several, memory-mapped from the snapshot or queried from the database.
+# The rollups must match a groupby over the chart rows.
+#   python -m pytest tests
+
+PATHS = {
+    "csv": {"CHART_SNAPSHOT_DIR": "missing"},
+    "workers": {"CHART_SNAPSHOT_DIR": "missing", "CHART_BUILD_WORKERS": "2"},
+    "snapshot": {"CHART_SNAPSHOT_DIR": "snapshot"},
+    "database": {"CHART_SNAPSHOT_DIR": "missing", "CHART_DATABASE": "chart.db"},
+}
+
+
+@pytest.fixture(scope="module")
+def csv_path(tmp_path_factory):
+    directory = tmp_path_factory.mktemp("charts")
+    path = str(directory / "chart.csv")
+    generate(path, countries=4, months=8, artists=60, tracks=5, chart_size=30)
+    df, months_years, history = parse(path)
+    write_snapshot(df, months_years, str(directory / "snapshot"), path, build_cubes(df, len(months_years)), history)
+    write_database(df, months_years, str(directory / "chart.db"), path)
+    return path
+
+
+# The app over every path: the callbacks without the cache and the instrumentation, with store.current set to
+# the chart loaded that way
+@pytest.fixture(scope="module")
+def charts(csv_path):
+    directory = os.path.dirname(csv_path)
+    names = ["CHART_CSV", "CHART_PRERENDERED_DIR"] + sorted({name for env in PATHS.values() for name in env})
+    saved = {name: os.environ.get(name) for name in names}
+    os.environ.update(CHART_CSV=csv_path, CHART_PRERENDERED_DIR="",
+                      CHART_SNAPSHOT_DIR=os.path.join(directory, "missing"))
+    try:
+        app = importlib.import_module("app")
+        charts = {}
+        for path, env in PATHS.items():
+            for name in names[2:]:
+                os.environ.pop(name, None)
+            os.environ.update({name: os.path.join(directory, value) if name != "CHART_BUILD_WORKERS" else value
+                               for name, value in env.items()})
+            charts[path] = app.load_chart()
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+    yield app, charts
+    app.store.chart = charts["csv"]
+
+
+def outputs(app, chart):
+    app.store.chart = chart
+    callbacks = {name: inspect.unwrap(getattr(app, name)) for name in
+                 ["set_artist_options", "set_song_options", "set_song_value", "update_charts", "update_choropleth_map"]}
+    first, last = chart.full_range
+    countries = chart.av_country
+    results = []
+    for date in [[first, last], [first + 2, last - 1], [last, last]]:
+        for country in ["Global", countries[1]]:
+            artists = list(chart.cubes["country_artist"].search(date[0], date[1], (country,), None, 3))
+            songs = list(chart.cubes["country_track"].search(date[0], date[1], (country, artists[:2]), None, 2))
+            results.append(callbacks["set_artist_options"](country, date, None, None))
+            results.append(callbacks["set_artist_options"](country, date, "1", artists[:1]))
+            results.append(callbacks["set_song_options"](country, date, artists[:2], None, None))
+            results.append(callbacks["set_song_options"](country, date, artists[:1], "2", songs[:1]))
+            results.append(callbacks["set_song_value"](country, date, artists[:1]))
+            for compare in [[], [c for c in countries if c != country][:2]]:
+                for selected in [([], []), (artists[:1], []), (artists[:2], []), (artists[:1], songs[:1]),
+                                 (artists[:2], songs), ([], songs[:1])]:
+                    results.append(callbacks["update_charts"](country, compare, *selected, date))
+            for selected in [([], []), (artists[:2], []), (artists[:2], songs), ([], songs[:1])]:
+                results.append(callbacks["update_choropleth_map"](*selected, date))
+    return [dumps(result) for result in results]
+
+
+def test_paths(charts):
+    _, charts = charts
+    assert isinstance(charts["snapshot"].cubes["country"].cells, np.memmap)
+    assert isinstance(charts["database"].engine, SQLiteEngine)
+
+
+@pytest.mark.parametrize("path", ["workers", "snapshot", "database"])
+def test_callbacks_match_csv(charts, path):
+    app, charts = charts
+    assert outputs(app, charts[path]) == outputs(app, charts["csv"])
+
+
+# The chart rows with their names and slider months
+def rows(chart):
+    df = chart.df.astype({column: object for column in ["Country", "Artist", "Track Name"]})
+    return df.assign(month_code=df["month_code"].astype(np.int64))
+
+
+@pytest.fixture(scope="module")
+def chart(csv_path):
+    df, months_years, history = parse(csv_path)
+    return ChartData(df, months_years, history=history)
+
+
+@pytest.mark.parametrize("date", [(0, 7), (2, 4), (5, 5)])
+def test_cubes_match_groupby(chart, date):
+    start, end = date
+    df = rows(chart)
+    df = df[(df["month_code"] >= start) & (df["month_code"] <= end)]
+    keys = ["Country", "Artist", "Track Name"]
+    expected = df.groupby(keys)["Streams"].sum().reset_index()
+    totals = chart.cubes["country_track"].totals(start, end).astype({key: object for key in keys})
+    pd.testing.assert_frame_equal(totals.reset_index(drop=True), expected, check_dtype=False)
+
+    for country in chart.av_country:
+        # Most streamed first, ties in name order
+        artists = df[df["Country"] == country].groupby("Artist")["Streams"].sum().reset_index()
+        artists = artists.sort_values(["Streams", "Artist"], ascending=[False, True])
+        names, streams = chart.cubes["country_artist"].top(start, end, (country,), 5)
+        assert list(names) == artists["Artist"].tolist()[:5]
+        assert list(streams) == artists["Streams"].tolist()[:5]
+        for artist in artists["Artist"].tolist()[:3]:
+            songs = df[(df["Country"] == country) & (df["Artist"] == artist)].groupby("Track Name")["Streams"].sum()
+            songs = songs.reset_index().sort_values(["Streams", "Track Name"], ascending=[False, True])
+            for rank, song in enumerate(songs["Track Name"]):
+                assert chart.cubes["country_track"].rank(start, end, (country, artist), song) == rank
+        assert chart.cubes["country_track"].rank(start, end, (country, "Nobody"), "Nothing") is None
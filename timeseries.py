@@ -0,0 +1,77 @@
+import numpy as np
+import pandas as pd
+
+# Time axis of the line chart. The chart files can hold one chart per day; the line chart sums the streams per
+# day, week or month, the finest of them that fits the point budget for the slider span, and thins out whatever
+# still exceeds the budget with largest-triangle-three-buckets (LTTB), which keeps the peaks and dips.
+
+# Upper bound of the days and weeks in a span of slider months
+PERIODS = {"day": 31, "week": 5, "month": 1}
+
+
+def resolution(start, end, points):
+    months = end - start + 1
+    for level in ["day", "week"]:
+        if months * PERIODS[level] <= points:
+            return level
+    return "month"
+
+
+# Bucket of every row: its day, its week (starting on Monday) or its slider month. days holds the days since
+# 1970-01-01 of the rows.
+def buckets(days, month_codes, level):
+    if level == "day":
+        return days
+    if level == "week":
+        # 1970-01-01 was a Thursday
+        return (days + 3) // 7
+    return month_codes
+
+
+# Streams per bucket of the level, at the first date of the bucket with data, thinned out to at most points rows.
+# series holds the streams per date sorted by date, with the day and month_code of each, as the engines return it.
+# With by, it holds several series sorted by those columns first, and each of them is rolled up and thinned out.
+# Weeks are the mean streams of their dates instead of the sum: the first and last week of the slider range are
+# cut at the range's edges, and a sum would show them as dips next to the full weeks.
+def rollup(series, level, points, by=()):
+    keys = buckets(series["day"].to_numpy(), series["month_code"].to_numpy(), level)
+    # The buckets (and the series) of rows sorted by date are runs of rows
+    change = np.diff(keys, prepend=keys[:1] - 1) != 0
+    series_starts = np.zeros(len(keys), dtype=bool)
+    series_starts[:1] = True
+    for column in by:
+        values = series[column].to_numpy()
+        series_starts[1:] |= values[1:] != values[:-1]
+    starts = np.flatnonzero(change | series_starts)
+    streams = series["Streams"].to_numpy()
+    sums = np.add.reduceat(streams, starts) if len(starts) else streams[:0]
+    if level == "week":
+        dates = np.diff(np.append(starts, len(keys)))
+        sums = (sums + dates // 2) // dates
+    columns = {column: series[column].to_numpy()[starts] for column in list(by) + ["Date", "day"]}
+    df = pd.DataFrame(dict(columns, Streams=sums), index=keys[starts])
+    bounds = np.append(np.flatnonzero(series_starts[starts]), len(df))
+    keep = [lo + lttb(df["day"].to_numpy()[lo:hi], df["Streams"].to_numpy()[lo:hi], points)
+            for lo, hi in zip(bounds[:-1], bounds[1:])]
+    return df.iloc[np.concatenate(keep + [np.arange(0)])]
+
+
+# Positions of at most n points of the series (x ascending) that keep its visual shape
+def lttb(x, y, n):
+    if n < 3 or len(x) <= n:
+        return np.arange(len(x))
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    # The first and the last point are kept, the others fall into n - 2 buckets of one point each
+    edges = np.linspace(1, len(x) - 1, n - 1).astype(int)
+    keep = [0]
+    for i in range(n - 2):
+        lo, hi = edges[i], edges[i + 1]
+        next_hi = edges[i + 2] if i + 2 < len(edges) else len(x)
+        next_x, next_y = x[hi:next_hi].mean(), y[hi:next_hi].mean()
+        a = keep[-1]
+        # Twice the area of the triangle between the last kept point, each candidate and the next bucket's mean
+        area = np.abs((x[a] - next_x) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (next_y - y[a]))
+        keep.append(lo + int(area.argmax()))
+    keep.append(len(x) - 1)
+    return np.array(keep)